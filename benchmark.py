@@ -0,0 +1,192 @@
+"""Load test for the user bot against local Telegram and OpenAI stand-ins.
+
+    python benchmark.py --users 10,100,1000,10000 --messages 3 --openai-latency 0.5
+
+Drives the real Application handlers (user_message, user_photo, user_document, user_file_callback)
+with synthetic updates and reports throughput, p50/p99 latency and memory growth for each scale.
+The fakes run in a separate process so their CPU time doesn't count against the bot. Everything runs
+in a temporary directory with its own user store; .env secrets are never used.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from fake_telegram import FakeBotAPI, message_update, photo_update, document_update, callback_update
+from fake_openai import FakeOpenAI
+
+PROMPTS = ["Hi!", "What is the capital of France?", "Write a python function that reverses a list", "Thanks", "Explain recursion simply"]
+
+def rss_mb():
+    """Current resident set size in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+def make_update(kind, uid, i, rnd):
+    if kind == "photo": return photo_update(uid, f"photo_{uid}_{i}", caption=None)
+    if kind == "document": return document_update(uid, f"doc_{uid}_{i}", f"notes_{i}.txt")
+    if kind == "export": return callback_update(uid, "fmt_" + rnd.choice(["txt", "pdf", "docx"]))
+    return message_update(uid, rnd.choice(PROMPTS))
+
+def percentile(data, q):
+    return data[min(len(data) - 1, int(q * len(data)))] if data else 0.0
+
+def error_count(bot):
+    return sum(v for (name, _), v in bot.METRICS.counters.items() if name == "bot_errors_total")
+
+def configure_env(args, tg_url, openai_url):
+    os.environ.update({
+        "BOT_TOKEN": "123:bench",
+        "ADMIN_BOT_TOKEN": "456:bench",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": openai_url,
+        "TELEGRAM_API_URL": tg_url,
+        "STATE_BACKEND": args.backend,
+        "WEBHOOK_URL": "",
+        "STREAM_REPLIES": "1" if args.stream else "0"
+    })
+    for tier in ("BASIC", "PRO", "PREMIUM"): os.environ[f"OPENAI_CONCURRENCY_{tier}"] = str(args.openai_concurrency)
+    if not args.real_rate_limits:
+        for name in ("RPM_GPT4O", "TPM_GPT4O", "RPM_GPT4O_MINI", "TPM_GPT4O_MINI", "RPM_DALLE3"): os.environ[name] = "0"
+
+async def run_scale(bot, app, n_users, first_uid, args):
+    """Every simulated user sends `args.messages` updates one after another; users run concurrently."""
+    from telegram import Update
+    kinds, weights = zip(*parse_mix(args.mix).items())
+    for uid in range(first_uid, first_uid + n_users):
+        bot.USERS[uid] = {
+            "name": f"User{uid}", "approved": True, "tier": random.Random(uid).choice(["Basic", "Basic", "Pro", "Premium"]),
+            "used": 0, "photos_used": 0, "img_gen_used": 0, "last_active_month": time.strftime("%Y-%m"), "lang": "en",
+            "history": [], "temp_photos": [], "img_turn_count": 0, "last_bot_text": None, "waiting_for_img": False
+        }
+    latencies = []
+    sem = asyncio.Semaphore(args.concurrency or n_users)
+
+    async def user(uid):
+        rnd = random.Random(uid * 7919)
+        for i in range(args.messages):
+            update = Update.de_json(make_update(rnd.choices(kinds, weights)[0], uid, i, rnd), app.bot)
+            async with sem:
+                start = time.perf_counter()
+                await app.process_update(update)
+                latencies.append(time.perf_counter() - start)
+
+    errors_before, rss_before = error_count(bot), rss_mb()
+    start = time.perf_counter()
+    await asyncio.gather(*(user(uid) for uid in range(first_uid, first_uid + n_users)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    rss_after = rss_mb()
+    print(f"{n_users:>7} {len(latencies):>8} {elapsed:>8.2f} {len(latencies) / elapsed:>8.1f} "
+          f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} "
+          f"{error_count(bot) - errors_before:>6} {rss_after:>8.1f} {rss_after - rss_before:>+8.1f}", flush=True)
+
+def import_report(top):
+    """Runs `python -X importtime -c "import bot_chatgpt"` in a fresh interpreter and prints the slowest imports.
+
+    Returns the total import time of bot_chatgpt in milliseconds.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot_chatgpt"], env=env, capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+        rows.append((int(parts[1]), parts[2].strip()))
+    total = next((us for us, name in rows if name == "bot_chatgpt"), 0) / 1000
+    print(f"import bot_chatgpt: {total:.0f} ms (fresh interpreter); slowest modules, cumulative:")
+    own = [(us, name) for us, name in rows if name != "bot_chatgpt" and "." not in name]
+    for us, name in sorted(own, reverse=True)[:top]: print(f"  {us / 1000:>8.1f} ms  {name}")
+    return total
+
+def serve_fakes(args, ready):
+    """Child process: runs both stand-ins until terminated."""
+    async def serve():
+        tg = FakeBotAPI(latency=args.tg_latency, error_rate=args.tg_errors)
+        ai = FakeOpenAI(latency=args.openai_latency, token_delay=args.token_delay, error_rate=args.openai_errors)
+        await tg.start(port=args.tg_port)
+        await ai.start(port=args.openai_port)
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+async def main(args):
+    ready = multiprocessing.Event()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(args, ready), daemon=True)
+    fakes.start()
+    if not ready.wait(30): raise SystemExit("fake servers did not start")
+    tg_url, openai_url = f"http://127.0.0.1:{args.tg_port}", f"http://127.0.0.1:{args.openai_port}/v1"
+    configure_env(args, tg_url, openai_url)
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+
+    if args.import_top: import_report(args.import_top)
+    start = time.perf_counter()
+    import bot_chatgpt as bot
+    imported = time.perf_counter()
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    app = bot.build_user_app()
+    bot.user_bot_app = app
+    await app.initialize()
+    await asyncio.to_thread(bot.load_encoding)  # as main() does, off the loop
+    print(f"startup: import {(imported - start) * 1000:.0f} ms, build + initialize {(time.perf_counter() - imported) * 1000:.0f} ms")
+
+    print(f"workdir {workdir}, backend {args.backend}, stream {args.stream}, mix {args.mix}")
+    print(f"{'users':>7} {'updates':>8} {'seconds':>8} {'msg/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6} {'rss MB':>8} {'growth':>8}")
+    first_uid = 1_000_000
+    try:
+        for n_users in (int(n) for n in args.users.split(",")):
+            await run_scale(bot, app, n_users, first_uid, args)
+            first_uid += n_users
+        async with httpx.AsyncClient() as http:
+            print(f"Telegram calls: {(await http.get(tg_url + '/_calls')).json()}")
+            print(f"OpenAI calls: {(await http.get(openai_url.rsplit('/v1', 1)[0] + '/_calls')).json()}")
+    finally:
+        await app.shutdown()
+        bot.USERS.flush()
+        fakes.terminate()
+
+def cli():
+    parser = argparse.ArgumentParser(description="Benchmark the user bot handlers against local fakes")
+    parser.add_argument("--users", default="10,100,1000", help="comma-separated simulated user counts (e.g. 10,100,1000,10000)")
+    parser.add_argument("--messages", type=int, default=3, help="updates sent by each simulated user")
+    parser.add_argument("--mix", default="text=80,photo=8,document=4,export=8", help="relative weights of update kinds")
+    parser.add_argument("--concurrency", type=int, default=0, help="max updates in flight (default: one per user)")
+    parser.add_argument("--backend", default="memory", choices=["memory", "sqlite"], help="STATE_BACKEND for the run")
+    parser.add_argument("--stream", action="store_true", help="use streamed replies with message edits")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--openai-errors", type=float, default=0.0, help="fraction of OpenAI calls answered with 429")
+    parser.add_argument("--openai-concurrency", type=int, default=256, help="OPENAI_CONCURRENCY_<TIER> for the run")
+    parser.add_argument("--real-rate-limits", action="store_true", help="keep MODEL_RATE_LIMITS instead of disabling them")
+    parser.add_argument("--tg-latency", type=float, default=0.02)
+    parser.add_argument("--tg-errors", type=float, default=0.0, help="fraction of Bot API calls answered with 429")
+    parser.add_argument("--tg-port", type=int, default=8081)
+    parser.add_argument("--openai-port", type=int, default=8082)
+    parser.add_argument("--import-top", type=int, default=10, help="slowest top-level imports to list (0 skips the importtime report)")
+    asyncio.run(main(parser.parse_args()))
+
+if __name__ == "__main__":
+    cli()
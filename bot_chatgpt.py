@@ -1,16 +1,34 @@
 import os
+import sys
 import logging
 import base64
+import io
 import json
+import hashlib
+import sqlite3
 import asyncio
 import re
 import datetime
+import uuid
+import functools
+import signal
+import time
+import random
+import secrets
+import hmac
+import heapq
+import itertools
+import contextlib
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import httpx
 from dotenv import load_dotenv
+from workers import extract_document, render_export
 
-from fpdf import FPDF
-from docx import Document
-from pypdf import PdfReader
-from bs4 import BeautifulSoup 
+# fpdf, python-docx, pypdf and BeautifulSoup are imported where they are used (the worker processes),
+# which keeps them out of the bot's startup time
 
 from telegram import (
     Update, 
@@ -21,6 +39,7 @@ from telegram import (
     InputMediaPhoto,
     LabeledPrice
 )
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -30,7 +49,6 @@ from telegram.ext import (
     CallbackQueryHandler,
     PreCheckoutQueryHandler
 )
-from openai import OpenAI
 
 # --- CONFIGURATION ---
 load_dotenv()
@@ -38,6 +56,9 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_BOT_TOKEN = os.getenv("ADMIN_BOT_TOKEN")
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")  # e.g. a local Bot API server or the benchmark stand-in
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "64"))  # concurrent Bot API connections per bot (library default is 1)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))  # >0: user bot handles that many updates at once (one at a time per user)
 
 # PAYMENT TOKENS
 PAYMENT_TOKENS = {
@@ -46,14 +67,188 @@ PAYMENT_TOKENS = {
     "stripe": os.getenv("PAYMENT_TOKEN_STRIPE")
 }
 
-client = OpenAI(api_key=OPENAI_KEY)
+# WEBHOOKS (both bots share one HTTP server; polling is used when WEBHOOK_URL is empty)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # random per start when empty: webhook POSTs are always authenticated
+
+# METRICS (Prometheus text format at /metrics on METRICS_LISTEN:METRICS_PORT; on the public webhook server only with a token)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # bearer token required to scrape; without it /metrics is not on the webhook server
+
+# OPENAI CONNECTION POOL
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "4"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "6"))  # image generation jobs processed at once
+
+# Broadcasts and admin notifications: Telegram allows about 30 messages/sec to different chats per bot
+FANOUT_RATE = float(os.getenv("FANOUT_RATE", "25"))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "32"))
+FANOUT_RETRIES = 3
+
+# STREAMING REPLIES
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # Telegram tolerates ~1 edit/sec per chat
+
+# VISION PAYLOADS
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "64"))
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1536"))  # 0 keeps uploads at original size
+VISION_DETAIL = os.getenv("VISION_DETAIL", "auto")  # "auto", "low" or "high" detail for photos sent to the model
+VISION_LOW_SIDE = 512  # low-detail photos are sent at this size; the model sees no more anyway
+VISION_CLASSIFIER = os.getenv("VISION_CLASSIFIER") == "1"  # ask SUMMARY_MODEL when cheap signals can't decide
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", "1.0"))  # seconds to wait for the rest of an album after each photo
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+MEDIA_TTL_HOURS = float(os.getenv("MEDIA_TTL_HOURS", "24"))  # photos unused this long are deleted
+MEDIA_MAX_MB = int(os.getenv("MEDIA_MAX_MB", "1024"))  # oldest photos are deleted beyond this
+MEDIA_GC_INTERVAL = 600
+
+# CACHES
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE") == "1"  # opt-in: reuse completions for identical prompts in identical context
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MB = int(os.getenv("RESPONSE_CACHE_MB", "16"))
+RESPONSE_CACHE_CONTEXT = int(os.getenv("RESPONSE_CACHE_CONTEXT", "2"))  # only turns with at most this many past messages are cached
+FILE_CACHE_MB = int(os.getenv("FILE_CACHE_MB", "32"))
+
+# FILE EXPORT
+PDF_FONT = os.getenv("PDF_FONT", "")  # TTF with Cyrillic coverage; common system fonts are tried when empty
+PDF_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf"
+]
+
+# DOCUMENT INGESTION
+DOC_MAX_MB = int(os.getenv("DOC_MAX_MB", "20"))
+DOC_MAX_PAGES = int(os.getenv("DOC_MAX_PAGES", "200"))
+DOC_INDEX_CHARS = int(os.getenv("DOC_INDEX_CHARS", "1000000"))  # extraction stops once this much text is indexed
+DOC_PREVIEW_CHARS = int(os.getenv("DOC_PREVIEW_CHARS", "1000"))
+DOC_CHUNK_CHARS = int(os.getenv("DOC_CHUNK_CHARS", "1000"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+DOCS_DB = os.getenv("DOCS_DB", "docs.db")  # local to the host, not in the state backend
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "2"))  # document parsing and file export
+DOC_TIMEOUT = float(os.getenv("DOC_TIMEOUT", "60"))
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("fontTools").setLevel(logging.WARNING)
+
+class LazyOpenAI:
+    """The shared AsyncOpenAI client, created on first use: importing openai takes about half a second."""
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _create(self):
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        return AsyncOpenAI(
+            api_key=OPENAI_KEY,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0,  # OpenAIPool retries 429s (back through the rate scheduler), connection errors, timeouts and 5xx
+            http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS))
+        )
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None: self._client = self._create()
+        return getattr(self._client, name)
+
+def rate_limit_error():
+    """openai.RateLimitError, imported on demand like the client."""
+    from openai import RateLimitError
+    return RateLimitError
+
+def transient_errors():
+    """Connection failures, timeouts and 5xx responses that the SDK used to retry itself."""
+    from openai import APIConnectionError, APITimeoutError, InternalServerError
+    return (APIConnectionError, APITimeoutError, InternalServerError)
+
+# One shared async client so keep-alive connections are reused across all handlers
+client = LazyOpenAI()
+
+# --- METRICS ---
+class Metrics:
+    """Process-local latency histograms and counters, exported in Prometheus text format."""
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    SAMPLES = 2048  # recent observations kept per series for admin percentiles
+
+    def __init__(self):
+        self.hists = {}
+        self.samples = {}
+        self.counters = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        hist = self.hists.get(key)
+        if hist is None:
+            hist = self.hists[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            self.samples[key] = deque(maxlen=self.SAMPLES)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound: hist[0][i] += 1
+        hist[1] += seconds
+        hist[2] += 1
+        self.samples[key].append(seconds)
+
+    def inc(self, name, n=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try: yield
+        finally: self.observe(name, time.monotonic() - start, **labels)
+
+    def percentile(self, key, q):
+        data = sorted(self.samples[key])
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = []
+        for name in sorted({k[0] for k in self.hists}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), (buckets, total, count) in self.hists.items():
+                if n != name: continue
+                for bound, c in zip(self.BUCKETS, buckets): lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {c}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name in sorted({k[0] for k in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in self.counters.items():
+                if n == name: lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
 
 # --- DATABASE ---
-DB_FILE = "users.json"
-ADMINS_FILE = "admins.json"
+# STATE_BACKEND: "sqlite" (local file, default), "redis" (shared by workers) or "memory" (tests/benchmarks).
+# User records and admins live in the backend; the document index (DOCS_DB) and album collection are per host/process,
+# so workers must run on one host sharing DOCS_DB, and album photos that reach different workers are answered separately.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_MULTI_PROCESS = os.getenv("STATE_MULTI_PROCESS") == "1"  # several workers share the SQLite file
+STATE_LOCK_TTL = int(os.getenv("STATE_LOCK_TTL", "30"))  # lease on a user's record; renewed while held, expires if the worker dies
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))  # user records kept in memory; least recently used are dropped
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))  # seconds a changed record may wait before it is written
+STATE_FLUSH_BATCH = int(os.getenv("STATE_FLUSH_BATCH", "200"))  # changed records that trigger an immediate flush
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+DB_FILE = os.getenv("USERS_DB", "users.db")
+LEGACY_DB_FILE = "users.json"
+ADMINS_FILE = "admins.json"  # legacy: imported into the backend once
+RECORD_DEFAULTS = {"lang": "en"}  # values a record without the field is treated as having
 
 def load_json(file):
     if not os.path.exists(file): return {}
@@ -63,15 +258,478 @@ def load_json(file):
             return {int(k): v for k, v in data.items()}
     except: return {}
 
-def save_json(file, data):
-    try:
-        with open(file, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f"Error saving {file}: {e}")
+def dump_record(rec):
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+
+def compact_record(rec):
+    """Shares repeated strings in a freshly decoded record: roles are interned and the last reply reuses its history entry."""
+    history = rec.get("history") or []
+    for m in history: m["role"] = sys.intern(m["role"])
+    last = rec.get("last_bot_text")
+    if last and history and history[-1]["content"] == last: rec["last_bot_text"] = history[-1]["content"]
+    return rec
+
+class MemoryBackend:
+    """Process-local records, for tests and benchmarks."""
+    shared = False
+    blocking = False
+
+    def __init__(self):
+        self.rows = {}
+        self.admin_rows = {}
+
+    def load(self, uid):
+        raw = self.rows.get(uid)
+        return json.loads(raw) if raw else None
+
+    def save(self, uid, rec):
+        self.rows[uid] = dump_record(rec)
+
+    def save_many(self, items):
+        for uid, rec in items: self.save(uid, rec)
+
+    def incr(self, uid, field, n):
+        rec = self.load(uid)
+        rec[field] = rec.get(field, 0) + n
+        self.save(uid, rec)
+        return rec[field]
+
+    def uids(self):
+        return list(self.rows)
+
+    def count(self):
+        return len(self.rows)
+
+    def admins(self):
+        return dict(self.admin_rows)
+
+    def add_admin(self, uid, info):
+        self.admin_rows[uid] = info
+
+    def audience(self, wanted):
+        recs = [(uid, json.loads(raw)) for uid, raw in list(self.rows.items())]
+        return [uid for uid, rec in recs if rec.get("approved") and all(rec.get(k, RECORD_DEFAULTS.get(k)) == v for k, v in wanted.items())]
+
+class SQLiteBackend:
+    """One JSON row per user in a WAL-mode SQLite file; `shared` when several worker processes use the file.
+
+    Shared files are `blocking`: lock polls and BEGIN IMMEDIATE can wait on another process's write lock.
+    """
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = self.blocking = shared
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")  # writes are batched by UserStore, so each batch can afford its fsync
+        self.conn.execute("CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS locks (uid INTEGER PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS admins (uid INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.commit()
+
+    def load(self, uid):
+        row = self.conn.execute("SELECT data FROM users WHERE uid = ?", (uid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, uid, rec):
+        with self.conn: self.conn.execute("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", (uid, dump_record(rec)))
+
+    def save_many(self, items):
+        with self.conn: self.conn.executemany("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", [(uid, dump_record(rec)) for uid, rec in items])
+
+    def incr(self, uid, field, n):
+        path = f"$.{field}"
+        with self.conn:
+            row = self.conn.execute(
+                "UPDATE users SET data = json_set(data, ?, COALESCE(json_extract(data, ?), 0) + ?) WHERE uid = ? RETURNING json_extract(data, ?)",
+                (path, path, n, uid, path)
+            ).fetchone()
+        return row[0]
+
+    def reserve(self, uid, field, limit, n):
+        path = f"$.{field}"
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")  # read and update under the write lock so other workers can't interleave
+            used = self.conn.execute("SELECT COALESCE(json_extract(data, ?), 0) FROM users WHERE uid = ?", (path, uid)).fetchone()[0]
+            take = max(0, min(n, limit - used))
+            if take: self.conn.execute("UPDATE users SET data = json_set(data, ?, ?) WHERE uid = ?", (path, used + take, uid))
+        return take, used + take
+
+    def uids(self):
+        return [row[0] for row in self.conn.execute("SELECT uid FROM users")]
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def admins(self):
+        return {uid: json.loads(data) for uid, data in self.conn.execute("SELECT uid, data FROM admins")}
+
+    def add_admin(self, uid, info):
+        with self.conn: self.conn.execute("INSERT OR REPLACE INTO admins (uid, data) VALUES (?, ?)", (uid, json.dumps(info, ensure_ascii=False)))
+
+    def audience(self, wanted):
+        """Filters in SQL on a connection of its own, so it can run in a thread next to the main one."""
+        sql, params = "SELECT uid FROM users WHERE json_extract(data, '$.approved')", []
+        for k, v in wanted.items():
+            sql += " AND COALESCE(json_extract(data, ?), ?) = ?"
+            params += [f"$.{k}", RECORD_DEFAULTS.get(k), v]
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            return [row[0] for row in conn.execute(sql, params)]
+
+    def try_lock(self, uid, token, ttl):
+        now = time.time()
+        with self.conn:
+            self.conn.execute("DELETE FROM locks WHERE uid = ? AND expires < ?", (uid, now))
+            cur = self.conn.execute("INSERT OR IGNORE INTO locks (uid, token, expires) VALUES (?, ?, ?)", (uid, token, now + ttl))
+        return cur.rowcount == 1
+
+    def renew(self, uid, token, ttl):
+        with self.conn: cur = self.conn.execute("UPDATE locks SET expires = ? WHERE uid = ? AND token = ?", (time.time() + ttl, uid, token))
+        return cur.rowcount == 1
+
+    def unlock(self, uid, token):
+        with self.conn: self.conn.execute("DELETE FROM locks WHERE uid = ? AND token = ?", (uid, token))
+
+class RedisBackend:
+    """Records as Redis hashes with one JSON value per field, so counters can be bumped with HINCRBY.
+
+    Works with any redis-py compatible client (e.g. fakeredis for local testing). Every call is a network
+    round trip, so UserStore runs them on its I/O thread instead of the event loop.
+    """
+    shared = True
+    blocking = True
+    UNLOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+    RESERVE_SCRIPT = (
+        "local used = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0') "
+        "local take = math.max(0, math.min(tonumber(ARGV[3]), tonumber(ARGV[2]) - used)) "
+        "if take > 0 then redis.call('hincrby', KEYS[1], ARGV[1], take) end "
+        "return {take, used + take}"
+    )
+
+    def __init__(self, client, prefix="chatgpt_bot:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def _key(self, uid):
+        return f"{self.prefix}user:{uid}"
+
+    def load(self, uid):
+        raw = self.client.hgetall(self._key(uid))
+        if not raw: return None
+        return {(k.decode() if isinstance(k, bytes) else k): json.loads(v) for k, v in raw.items()}
+
+    def save(self, uid, rec):
+        self.save_many([(uid, rec)])
+
+    def save_many(self, items):
+        pipe = self.client.pipeline()
+        for uid, rec in items:
+            key = self._key(uid)
+            pipe.delete(key)
+            pipe.hset(key, mapping={k: json.dumps(v, ensure_ascii=False) for k, v in rec.items()})
+            pipe.sadd(self.prefix + "users", uid)
+        pipe.execute()
+
+    def incr(self, uid, field, n):
+        return self.client.hincrby(self._key(uid), field, n)
+
+    def reserve(self, uid, field, limit, n):
+        take, used = self.client.eval(self.RESERVE_SCRIPT, 1, self._key(uid), field, limit, n)
+        return int(take), int(used)
+
+    def uids(self):
+        return [int(uid) for uid in self.client.smembers(self.prefix + "users")]
+
+    def count(self):
+        return self.client.scard(self.prefix + "users")
+
+    def admins(self):
+        return {int(uid): json.loads(data) for uid, data in self.client.hgetall(self.prefix + "admins").items()}
+
+    def add_admin(self, uid, info):
+        self.client.hset(self.prefix + "admins", uid, json.dumps(info, ensure_ascii=False))
+
+    def audience(self, wanted):
+        uids, fields = self.uids(), ["approved", *wanted]
+        pipe = self.client.pipeline()
+        for uid in uids: pipe.hmget(self._key(uid), fields)
+        matches = []
+        for uid, values in zip(uids, pipe.execute()):
+            rec = {k: json.loads(v) for k, v in zip(fields, values) if v is not None}
+            if rec.get("approved") and all(rec.get(k, RECORD_DEFAULTS.get(k)) == v for k, v in wanted.items()): matches.append(uid)
+        return matches
+
+    def try_lock(self, uid, token, ttl):
+        return bool(self.client.set(f"{self.prefix}lock:{uid}", token, nx=True, ex=ttl))
+
+    def unlock(self, uid, token):
+        self.client.eval(self.UNLOCK_SCRIPT, 1, f"{self.prefix}lock:{uid}", token)
+
+    def renew(self, uid, token, ttl):
+        return bool(self.client.eval(self.RENEW_SCRIPT, 1, f"{self.prefix}lock:{uid}", token, ttl))
+
+class UserStore:
+    """Dict-like access to user records on top of a state backend.
+
+    Records are loaded on first access and cached. `save(uid)` only marks the record dirty; dirty records
+    are written in one batch every `flush_interval` seconds or once `flush_batch` of them pile up, and
+    `flush()` must be called on shutdown. With a shared backend a user's record is also written when
+    their lock is released, so other workers always read the latest version.
+    At most `max_cached` records stay in memory: the least recently used are dropped (after being written
+    if dirty), except users whose lock is held.
+    Calls to a `blocking` backend (Redis, shared SQLite) go through one I/O thread, in order. The async
+    paths (lock, reserve, incr, flushes, fetch) await it; a user's record is loaded when their lock is
+    taken, so handlers running under the lock read it from the cache, and code outside the lock uses
+    fetch(). Dirty records are not evicted until the flusher has written them.
+    """
+    def __init__(self, backend, legacy_file=None, legacy_admins=None, max_cached=USER_CACHE_SIZE, flush_interval=STATE_FLUSH_INTERVAL, flush_batch=STATE_FLUSH_BATCH):
+        self.make_backend = backend if callable(backend) else lambda: backend  # a backend or a factory for one
+        self.legacy_file = legacy_file
+        self.legacy_admins = legacy_admins
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.cache = OrderedDict()
+        self.dirty = set()
+        self.locks = {}
+        self.flusher = None
+        self.full = None  # set once flush_batch records are dirty: the flusher writes without waiting
+
+    @functools.cached_property
+    def backend(self):
+        """Created on first use, so importing the module (as spawned pool workers do) opens no database or connection."""
+        backend = self.make_backend()
+        if self.legacy_file: self._import_legacy(backend, self.legacy_file)
+        if self.legacy_admins: self._import_legacy_admins(backend, self.legacy_admins)
+        return backend
+
+    @functools.cached_property
+    def io(self):
+        return ThreadPoolExecutor(1, thread_name_prefix="user-store") if self.backend.blocking else None
+
+    def _import_legacy(self, backend, file):
+        """One-time migration of the old whole-file users.json into the backend."""
+        if not os.path.exists(file) or backend.count(): return
+        data = load_json(file)
+        backend.save_many(data.items())
+        logger.info(f"Migrated {len(data)} users from {file} to {STATE_BACKEND}")
+
+    def _import_legacy_admins(self, backend, file):
+        """One-time migration of admins.json, so every worker sees the same admins."""
+        if not os.path.exists(file) or backend.admins(): return
+        data = load_json(file)
+        for uid, info in data.items(): backend.add_admin(int(uid), info)
+        logger.info(f"Migrated {len(data)} admins from {file} to {STATE_BACKEND}")
+
+    def _call(self, fn, *args):
+        """Synchronous backend call, for startup and shutdown; handlers use _acall."""
+        return self.io.submit(fn, *args).result() if self.io else fn(*args)
+
+    async def _acall(self, fn, *args):
+        return await asyncio.wrap_future(self.io.submit(fn, *args)) if self.io else fn(*args)
+
+    def _load(self, uid):
+        rec = self._call(self.backend.load, uid)
+        if rec is not None: self._put(uid, compact_record(rec))
+        return rec
+
+    def _put(self, uid, rec):
+        self.cache[uid] = rec
+        self.cache.move_to_end(uid)
+        if len(self.cache) > self.max_cached: self._evict()
+
+    def _evict(self):
+        for _ in range(len(self.cache) - 1):  # never the record just put, which its caller may be about to mark dirty
+            if len(self.cache) <= self.max_cached: return
+            uid = next(iter(self.cache))
+            if uid in self.locks or uid in self.dirty:  # dirty ones go once the flusher has written them
+                self.cache.move_to_end(uid)
+                continue
+            del self.cache[uid]
+            METRICS.inc("bot_user_cache_evictions_total")
+
+    def __contains__(self, uid):
+        return uid in self.cache or self._load(uid) is not None
+
+    def __getitem__(self, uid):
+        rec = self.cache.get(uid)
+        if rec is None: rec = self._load(uid)
+        else: self.cache.move_to_end(uid)
+        if rec is None: raise KeyError(uid)
+        return rec
+
+    def get(self, uid, default=None):
+        try: return self[uid]
+        except KeyError: return default
+
+    async def fetch(self, uid):
+        """The record or None, loading a cache miss without blocking the loop; for code running outside the user's lock."""
+        if uid in self.cache or not self.io: return self.get(uid)
+        rec = await self._acall(self.backend.load, uid)
+        if rec is not None and uid not in self.cache: self._put(uid, compact_record(rec))
+        return self.cache.get(uid)
+
+    def __setitem__(self, uid, rec):
+        self._put(uid, rec)
+        self.save(uid)
+
+    def save(self, uid):
+        if uid not in self.cache: return
+        self.dirty.add(uid)
+        if self.flusher is None:
+            try: loop = asyncio.get_running_loop()
+            except RuntimeError: return self.flush()  # no event loop (startup scripts): write through
+            self.full = asyncio.Event()
+            self.flusher = loop.create_task(self._flush_later())
+        if len(self.dirty) >= self.flush_batch: self.full.set()
+
+    async def _flush_later(self):
+        try:
+            with contextlib.suppress(asyncio.TimeoutError): await asyncio.wait_for(self.full.wait(), self.flush_interval)
+        finally:
+            self.flusher = self.full = None
+            await self.aflush()
+
+    def _take(self, uids):
+        """Marks records clean and snapshots them, so changes made while the write is in flight stay dirty."""
+        self.dirty.difference_update(uids)
+        return [(uid, dict(self.cache[uid])) for uid in uids if uid in self.cache]
 
-USERS = load_json(DB_FILE)
-ADMINS = load_json(ADMINS_FILE)
+    def _failed(self, items, e):
+        self.dirty.update(uid for uid, _ in items)
+        METRICS.inc("bot_errors_total", where="db_save", type=type(e).__name__)
+        logger.error(f"Error saving {len(items)} users: {e}")
+
+    def _write(self, uids):
+        items = self._take(uids)
+        try:
+            with METRICS.timer("bot_stage_seconds", stage="db_save"): self._call(self.backend.save_many, items)
+        except Exception as e:
+            self._failed(items, e)
+            return False
+        return True
+
+    async def _awrite(self, uids):
+        items = self._take(uids)
+        try:
+            with METRICS.timer("bot_stage_seconds", stage="db_save"): await self._acall(self.backend.save_many, items)
+        except Exception as e:
+            self._failed(items, e)
+            return False
+        return True
+
+    def flush(self):
+        """Writes every dirty record in one batch; failed records stay dirty for the next flush."""
+        if self.dirty: self._write(list(self.dirty))
+
+    async def aflush(self):
+        if self.dirty: await self._awrite(list(self.dirty))
+
+    async def commit(self, uid):
+        """Writes one record now rather than with the next batch, for changes a crash must not lose (payments, approvals)."""
+        if uid not in self.cache: return
+        self.dirty.add(uid)
+        if not await self._awrite([uid]): self.save(uid)  # still dirty: the flusher retries it
+
+    async def incr(self, uid, field, n=1):
+        """Adds `n` to a counter; with a shared backend the increment is atomic in the backend."""
+        rec = self[uid]
+        if not self.backend.shared:
+            rec[field] = rec.get(field, 0) + n
+            self.save(uid)
+            return rec[field]
+        if uid in self.dirty: await self._awrite([uid])
+        rec[field] = await self._acall(self.backend.incr, uid, field, n)
+        return rec[field]
+
+    async def reserve(self, uid, field, limit, n=1):
+        """Takes up to `n` units of a counter capped at `limit` and returns how many were taken.
+
+        The check and the increment are one step (a conditional update in shared backends), so concurrent
+        handlers and workers can't overshoot a limit. Unused units are given back with incr(uid, field, -k).
+        """
+        rec = self[uid]
+        if not self.backend.shared:
+            take = max(0, min(n, limit - rec.get(field, 0)))
+            if take: await self.incr(uid, field, take)
+            return take
+        if uid in self.dirty: await self._awrite([uid])
+        take, rec[field] = await self._acall(self.backend.reserve, uid, field, limit, n)
+        return take
+
+    @contextlib.asynccontextmanager
+    async def lock(self, uid):
+        """Exclusive access to one user's record.
+
+        With a shared backend the lease is taken in the backend (so other workers wait too), renewed
+        while the block runs, and the record is re-read on entry.
+        """
+        entry = self.locks.setdefault(uid, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if not self.backend.shared:
+                    yield
+                    return
+                token = uuid.uuid4().hex
+                while not await self._acall(self.backend.try_lock, uid, token, STATE_LOCK_TTL): await asyncio.sleep(0.05)
+                if uid in self.dirty: await self._awrite([uid])
+                self.cache.pop(uid, None)
+                rec = await self._acall(self.backend.load, uid)
+                if rec is not None: self._put(uid, compact_record(rec))
+                renewer = asyncio.create_task(self._renew(uid, token))
+                try: yield
+                finally:
+                    renewer.cancel()
+                    if uid in self.dirty: await self._awrite([uid])
+                    await self._acall(self.backend.unlock, uid, token)
+        finally:
+            entry[1] -= 1
+            if not entry[1]: del self.locks[uid]
+
+    async def _renew(self, uid, token):
+        """Extends a held lease every third of its TTL, so long handlers (retries, streaming) keep it."""
+        while True:
+            await asyncio.sleep(STATE_LOCK_TTL / 3)
+            try:
+                if await self._acall(self.backend.renew, uid, token, STATE_LOCK_TTL): continue
+                logger.error(f"State lock for {uid} expired while held")
+                return
+            except Exception as e:
+                logger.error(f"Error renewing state lock for {uid}: {e}")
+
+    async def admins(self):
+        """Admin accounts by user id, read from the backend so a /login on any worker counts everywhere."""
+        return await self._acall(self.backend.admins)
+
+    async def add_admin(self, uid, info):
+        await self._acall(self.backend.add_admin, uid, info)
+
+    async def audience(self, wanted):
+        """Uids of approved users whose fields equal `wanted` (e.g. {"tier": "Pro"}).
+
+        Pending changes are written first; the backend filters in a thread, without pulling records into the cache.
+        """
+        await self.aflush()
+        return await asyncio.to_thread(self.backend.audience, wanted)
+
+    def __iter__(self):
+        return iter(self._call(self.backend.uids))
+
+    def __len__(self):
+        return self._call(self.backend.count)
+
+def make_backend():
+    if STATE_BACKEND == "redis": return RedisBackend.from_url(REDIS_URL)
+    if STATE_BACKEND == "memory": return MemoryBackend()
+    return SQLiteBackend(DB_FILE, shared=STATE_MULTI_PROCESS)
+
+USERS = UserStore(make_backend, legacy_file=LEGACY_DB_FILE, legacy_admins=ADMINS_FILE)
 
 # --- LIMITS, MODELS & PRICES ---
 TIER_MODELS = {
@@ -80,6 +738,23 @@ TIER_MODELS = {
     "Premium": "gpt-4o"
 }
 
+# USD per 1M tokens (prompt, completion); images are priced per generated image
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60)
+}
+IMAGE_PRICES = {"1024x1024": 0.04, "1792x1024": 0.08, "1024x1792": 0.08}  # dall-e-3 standard quality
+
+# Prompt budget (tokens) for past turns + summary + current message
+TIER_CONTEXT_TOKENS = {
+    "Basic": 3000,
+    "Pro": 6000,
+    "Premium": 12000
+}
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_BACKLOG_FACTOR = 4  # turns waiting for the summary are capped at this many context budgets; older ones are dropped
+
 TIER_LIMITS = {
     "Basic": 500,
     "Pro": 500,
@@ -104,9 +779,211 @@ TIER_PRICES = {
     "Premium": 219000
 }
 
-HISTORY_LIMIT = 15
+# Max in-flight OpenAI requests per tier (override with OPENAI_CONCURRENCY_<TIER>)
+TIER_CONCURRENCY = {
+    "Basic": int(os.getenv("OPENAI_CONCURRENCY_BASIC", "8")),
+    "Pro": int(os.getenv("OPENAI_CONCURRENCY_PRO", "16")),
+    "Premium": int(os.getenv("OPENAI_CONCURRENCY_PREMIUM", "24"))
+}
+
+# Image jobs a tier may have generating at once, and variants one request may ask for
+TIER_IMG_CONCURRENCY = {
+    "Basic": 2,
+    "Pro": 3,
+    "Premium": 4
+}
+TIER_IMG_VARIANTS = {
+    "Basic": 1,
+    "Pro": 2,
+    "Premium": 4
+}
+
+# Model cascade: short chatter (no code, task verbs, photos or document excerpts, small context) goes to a
+# cheaper model. Per tier: (cheap model, max message tokens, max context tokens); None always uses TIER_MODELS.
+MODEL_CASCADE_ENABLED = os.getenv("MODEL_CASCADE", "1") == "1"
+MODEL_CASCADE = {
+    "Basic": None,
+    "Pro": ("gpt-4o-mini", int(os.getenv("CASCADE_MAX_TOKENS_PRO", "30")), int(os.getenv("CASCADE_MAX_CONTEXT_PRO", "2000"))),
+    "Premium": ("gpt-4o-mini", int(os.getenv("CASCADE_MAX_TOKENS_PREMIUM", "15")), int(os.getenv("CASCADE_MAX_CONTEXT_PREMIUM", "1000")))
+}
+
 PHOTO_MEMORY_TURNS = 5
 
+# OpenAI account limits per model: (requests/min, tokens/min). 0 disables that bucket.
+MODEL_RATE_LIMITS = {
+    "gpt-4o": (int(os.getenv("RPM_GPT4O", "500")), int(os.getenv("TPM_GPT4O", "30000"))),
+    "gpt-4o-mini": (int(os.getenv("RPM_GPT4O_MINI", "500")), int(os.getenv("TPM_GPT4O_MINI", "200000"))),
+    "dall-e-3": (int(os.getenv("RPM_DALLE3", "7")), 0)
+}
+
+# Lower value is served first when requests queue for rate budget
+TIER_PRIORITY = {
+    "Premium": 0,
+    "Pro": 1,
+    "Basic": 2
+}
+
+# --- OPENAI POOL ---
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute; the level may go negative to impose a penalty."""
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, n):
+        """Seconds until `n` units are available (0 if they are available now)."""
+        self._refill()
+        n = min(n, self.capacity)
+        return 0.0 if self.level >= n else (n - self.level) / self.rate
+
+    def take(self, n):
+        self._refill()
+        self.level -= n
+
+class RateScheduler:
+    """Per-model RPM/TPM token buckets. Waiting requests are released in TIER_PRIORITY order."""
+    def __init__(self, limits):
+        self.buckets = {model: (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None) for model, (rpm, tpm) in limits.items()}
+        self.queues = {model: [] for model in limits}
+        self.tasks = {}
+        self.seq = itertools.count()
+
+    async def acquire(self, model, tier, tokens):
+        if model not in self.buckets: return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queues[model], (TIER_PRIORITY.get(tier, len(TIER_PRIORITY)), next(self.seq), tokens, tier, fut))
+        if model not in self.tasks: self.tasks[model] = asyncio.create_task(self._dispatch(model))
+        await fut
+
+    async def _dispatch(self, model):
+        queue = self.queues[model]
+        req, tok = self.buckets[model]
+        while queue:
+            _, _, tokens, _, fut = queue[0]
+            if fut.done():
+                heapq.heappop(queue)
+                continue
+            wait = max(req.wait(1) if req else 0.0, tok.wait(tokens) if tok else 0.0)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(queue)
+            if req: req.take(1)
+            if tok: tok.take(tokens)
+            fut.set_result(None)
+        del self.tasks[model]
+
+    def backoff(self, model, delay):
+        """Holds all requests for `model` for about `delay` seconds after the API returned 429."""
+        req, _ = self.buckets.get(model, (None, None))
+        if req:
+            req._refill()
+            req.level = min(req.level, 0.0) - delay * req.rate
+
+    def stats(self):
+        """Queue depth per model and tier."""
+        depth = {}
+        for model, queue in self.queues.items():
+            for _, _, _, tier, fut in queue:
+                if fut.done(): continue
+                by_tier = depth.setdefault(model, {})
+                by_tier[tier] = by_tier.get(tier, 0) + 1
+        return depth
+
+RATE_SCHEDULER = RateScheduler(MODEL_RATE_LIMITS)
+
+def retry_delay(error, attempt):
+    """Server-suggested Retry-After if present, otherwise exponential backoff with jitter."""
+    try: return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError): return min(2 ** attempt, 30) + random.random()
+
+class OpenAIPool:
+    """Caps concurrent OpenAI requests per tier and tracks how long callers queue for a slot."""
+    SLOW_WAIT = 2.0
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.sems = {tier: asyncio.Semaphore(n) for tier, n in limits.items()}
+        self.waiting = {tier: 0 for tier in limits}
+        self.active = {tier: 0 for tier in limits}
+        self.calls = {tier: 0 for tier in limits}
+        self.wait_total = {tier: 0.0 for tier in limits}
+        self.wait_max = {tier: 0.0 for tier in limits}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tier):
+        """Holds one of the tier's request slots for the duration of the block (e.g. while a stream is consumed)."""
+        if tier not in self.sems: tier = "Basic"
+        start = time.monotonic()
+        self.waiting[tier] += 1
+        try:
+            await self.sems[tier].acquire()
+        finally:
+            self.waiting[tier] -= 1
+        waited = time.monotonic() - start
+        METRICS.observe("bot_stage_seconds", waited, stage="openai_queue", tier=tier)
+        self.calls[tier] += 1
+        self.wait_total[tier] += waited
+        self.wait_max[tier] = max(self.wait_max[tier], waited)
+        if waited > self.SLOW_WAIT:
+            logger.warning(f"OpenAI queue [{tier}]: waited {waited:.1f}s ({self.waiting[tier]} still waiting)")
+        self.active[tier] += 1
+        try:
+            yield
+        finally:
+            self.active[tier] -= 1
+            self.sems[tier].release()
+
+    @contextlib.asynccontextmanager
+    async def request(self, tier, model, tokens, fn, **kwargs):
+        """Waits for rate budget, then calls `fn(model=model, **kwargs)` in a tier slot, retrying 429s and transient errors.
+
+        The result is yielded while the slot is still held so streams can be consumed inside the block.
+        """
+        for attempt in range(OPENAI_RETRIES + 1):
+            await RATE_SCHEDULER.acquire(model, tier, tokens)
+            async with self.slot(tier):
+                try:
+                    with METRICS.timer("bot_stage_seconds", stage="openai", model=model):
+                        result = await fn(model=model, **kwargs)
+                except rate_limit_error() as e:
+                    METRICS.inc("bot_errors_total", where="openai", type="RateLimitError")
+                    if attempt == OPENAI_RETRIES: raise
+                    delay, reason = retry_delay(e, attempt), "429"
+                except transient_errors() as e:
+                    METRICS.inc("bot_errors_total", where="openai", type=type(e).__name__)
+                    if attempt == OPENAI_RETRIES: raise
+                    delay, reason = retry_delay(e, attempt), type(e).__name__
+                else:
+                    yield result
+                    return
+            logger.warning(f"OpenAI {reason} for {model} [{tier}], retry {attempt + 1} in {delay:.1f}s")
+            if reason == "429": RATE_SCHEDULER.backoff(model, delay)
+            await asyncio.sleep(delay)
+
+    async def run(self, tier, model, tokens, fn, **kwargs):
+        async with self.request(tier, model, tokens, fn, **kwargs) as result:
+            return result
+
+    def stats(self):
+        return {tier: {
+            "limit": self.limits[tier],
+            "active": self.active[tier],
+            "waiting": self.waiting[tier],
+            "calls": self.calls[tier],
+            "avg_wait": self.wait_total[tier] / self.calls[tier] if self.calls[tier] else 0.0,
+            "max_wait": self.wait_max[tier]
+        } for tier in self.limits}
+
+OPENAI_POOL = OpenAIPool(TIER_CONCURRENCY)
+
 # --- TEXTS ---
 AUTH_TEXTS = {
     "req": "🔒 Authentication Required\nPlease share your phone number.",
@@ -143,11 +1020,15 @@ TEXTS = {
         "listening": "👂 I'm listening...",
         "file_read": "📖 File read! I know the context now.",
         "file_error": "❌ Couldn't read file.",
+        "file_too_big": "❌ File is too large (max {mb} MB).",
+        "file_timeout": "⏳ Reading the file took too long (over {s} s). Try a smaller file.",
         "choose_lang": "🌐 Select Language:",
         "choose_tier": "⭐ **Select a Plan to Upgrade:**\n(Current: {tier})",
         "photo_limit": "❌ Photo upload limit reached! ({used}/{limit}).",
         "imggen_limit": "❌ Image generation limit reached! ({used}/{limit}). Upgrade your plan!",
-        "imggen_prompt": "🎨 **Image Generation Mode**\nDescribe the image you want me to create:",
+        "imggen_prompt": "🎨 **Image Generation Mode**\nDescribe the image you want me to create:\nAdd x2–x4 for variants, 16:9 or 9:16 for wide or tall.",
+        "imggen_queued": "⏳ Queued, you are #{pos} in line.",
+        "imggen_busy": "⏳ Your previous image is still being generated.",
         "imggen_wait": "🎨 Generating... (Takes ~10s)",
         "imggen_done": "🎨 Here is your image!",
         "pay_select": "💳 **Select Payment Method for {plan}:**\n💰 Price: {price} UZS",
@@ -155,7 +1036,10 @@ TEXTS = {
         "pay_invoice_desc": "Upgrade to {plan} for 1 month access.",
         "pay_thanks": "🎉 **Payment Successful!**\nYou have been upgraded to **{tier}**. Enjoy!",
         "pay_unavailable": "❌ This payment method is not available right now. Please try another.",
-        "pay_error": "❌ Payment failed or cancelled."
+        "pay_error": "❌ Payment failed or cancelled.",
+        "ai_busy": "⏳ I'm a bit overloaded right now. Please try again in a minute.",
+        "ai_error": "❌ Something went wrong. Please try again.",
+        "imggen_error": "❌ Couldn't generate the image. Try a different description."
     },
     # (Simplified other languages for brevity - you can copy paste English keys if missing)
     "ru": {
@@ -184,11 +1068,15 @@ TEXTS = {
         "listening": "👂 Слушаю...",
         "file_read": "📖 Файл прочитан!",
         "file_error": "❌ Ошибка чтения.",
+        "file_too_big": "❌ Файл слишком большой (макс. {mb} МБ).",
+        "file_timeout": "⏳ Файл читался слишком долго (более {s} с). Попробуйте файл поменьше.",
         "choose_lang": "🌐 Выберите язык:",
         "choose_tier": "⭐ **Выберите тариф для обновления:**\n(Текущий: {tier})",
         "photo_limit": "❌ Лимит загрузки фото исчерпан!",
         "imggen_limit": "❌ Лимит генерации исчерпан!",
-        "imggen_prompt": "🎨 **Режим Генерации**\nОпишите изображение:",
+        "imggen_prompt": "🎨 **Режим Генерации**\nОпишите изображение:\nДобавьте x2–x4 для вариантов, 16:9 или 9:16 для широкого или высокого.",
+        "imggen_queued": "⏳ В очереди, вы #{pos}.",
+        "imggen_busy": "⏳ Предыдущее изображение ещё создаётся.",
         "imggen_wait": "🎨 Рисую... (~10 сек)",
         "imggen_done": "🎨 Ваше изображение!",
         "pay_select": "💳 **Выберите способ оплаты для {plan}:**\n💰 Цена: {price} UZS",
@@ -196,7 +1084,10 @@ TEXTS = {
         "pay_invoice_desc": "Доступ к {plan} на 1 месяц.",
         "pay_thanks": "🎉 **Оплата прошла успешно!**\nВаш тариф обновлен до **{tier}**.",
         "pay_unavailable": "❌ Этот способ оплаты сейчас недоступен.",
-        "pay_error": "❌ Ошибка оплаты."
+        "pay_error": "❌ Ошибка оплаты.",
+        "ai_busy": "⏳ Сейчас слишком много запросов. Попробуйте через минуту.",
+        "ai_error": "❌ Что-то пошло не так. Попробуйте ещё раз.",
+        "imggen_error": "❌ Не удалось создать изображение. Попробуйте другое описание."
     },
     "uz": {
         "welcome": "👋 Salom {name}!\nMen tayyorman.",
@@ -224,11 +1115,15 @@ TEXTS = {
         "listening": "👂 Eshitayapman...",
         "file_read": "📖 Fayl o'qildi!",
         "file_error": "❌ O'qib bo'lmadi.",
+        "file_too_big": "❌ Fayl juda katta (maks. {mb} MB).",
+        "file_timeout": "⏳ Faylni o'qish juda uzoq davom etdi ({s} soniyadan ortiq). Kichikroq fayl yuboring.",
         "choose_lang": "🌐 Tilni tanlang:",
         "choose_tier": "⭐ **Tarifni yangilash:**\n(Hozirgi: {tier})",
         "photo_limit": "❌ Rasm yuklash limiti tugadi!",
         "imggen_limit": "❌ Rasm chizish limiti tugadi!",
-        "imggen_prompt": "🎨 **Rasm Chizish**\nQanday rasm chizay? Yozing:",
+        "imggen_prompt": "🎨 **Rasm Chizish**\nQanday rasm chizay? Yozing:\nVariantlar uchun x2–x4, keng yoki baland uchun 16:9 yoki 9:16 qo'shing.",
+        "imggen_queued": "⏳ Navbatdasiz, siz #{pos}.",
+        "imggen_busy": "⏳ Oldingi rasm hali chizilmoqda.",
         "imggen_wait": "🎨 Chizayapman... (~10 soniya)",
         "imggen_done": "🎨 Mana rasmingiz!",
         "pay_select": "💳 **{plan} uchun to'lov turini tanlang:**\n💰 Narx: {price} so'm",
@@ -236,7 +1131,10 @@ TEXTS = {
         "pay_invoice_desc": "{plan} tarifiga 1 oylik obuna.",
         "pay_thanks": "🎉 **To'lov muvaffaqiyatli!**\nSizning tarifingiz **{tier}** ga o'zgardi.",
         "pay_unavailable": "❌ Bu to'lov usuli hozir ishlamayapti.",
-        "pay_error": "❌ To'lovda xatolik."
+        "pay_error": "❌ To'lovda xatolik.",
+        "ai_busy": "⏳ Hozir so'rovlar juda ko'p. Bir daqiqadan so'ng urinib ko'ring.",
+        "ai_error": "❌ Xatolik yuz berdi. Qaytadan urinib ko'ring.",
+        "imggen_error": "❌ Rasm chizib bo'lmadi. Boshqa tavsif yozing."
     }
 }
 
@@ -248,15 +1146,21 @@ def get_text(uid, key, **kwargs):
     if kwargs: return val.format(**kwargs)
     return val
 
+MAIN_KEYBOARD_LAYOUT = [["btn_chat", "btn_file"], ["btn_analyze", "btn_imggen"], ["btn_uploads", "btn_usage"], ["btn_tier", "btn_lang"], ["btn_clear"]]
+LANG_BUTTONS = {"English 🇺🇸": "en", "Russian 🇷🇺": "ru", "Uzbek 🇺🇿": "uz"}
+
+def _label(lang, key):
+    return TEXTS[lang].get(key) or TEXTS["en"][key]
+
+# Built once: keyboards are immutable, and every localized label maps back to its button key
+MAIN_KEYBOARDS = {lang: ReplyKeyboardMarkup([[KeyboardButton(_label(lang, k)) for k in row] for row in MAIN_KEYBOARD_LAYOUT], resize_keyboard=True) for lang in TEXTS}
+LANG_KEYBOARD = ReplyKeyboardMarkup([list(LANG_BUTTONS)], resize_keyboard=True)
+FORMAT_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("📝 Word", callback_data="fmt_docx"), InlineKeyboardButton("📕 PDF", callback_data="fmt_pdf")], [InlineKeyboardButton("🐍 Python", callback_data="fmt_py"), InlineKeyboardButton("📄 Text", callback_data="fmt_txt")]])
+BUTTON_KEYS = {_label(lang, k): k for lang in TEXTS for row in MAIN_KEYBOARD_LAYOUT for k in row}
+BUTTON_KEYS.update(dict.fromkeys(LANG_BUTTONS, "lang_choice"))
+
 def get_main_keyboard(uid):
-    t = lambda k: get_text(uid, k)
-    return ReplyKeyboardMarkup([
-        [KeyboardButton(t("btn_chat")), KeyboardButton(t("btn_file"))],
-        [KeyboardButton(t("btn_analyze")), KeyboardButton(t("btn_imggen"))],
-        [KeyboardButton(t("btn_uploads")), KeyboardButton(t("btn_usage"))],
-        [KeyboardButton(t("btn_tier")), KeyboardButton(t("btn_lang"))],
-        [KeyboardButton(t("btn_clear"))]
-    ], resize_keyboard=True)
+    return MAIN_KEYBOARDS.get(USERS.get(uid, {}).get("lang", "en"), MAIN_KEYBOARDS["en"])
 
 def check_user(user):
     uid = user.id
@@ -278,7 +1182,6 @@ def check_user(user):
             "last_bot_text": None,
             "waiting_for_img": False
         }
-        save_json(DB_FILE, USERS)
     
     if "photos_used" not in USERS[uid]: USERS[uid]["photos_used"] = 0
     if "img_gen_used" not in USERS[uid]: USERS[uid]["img_gen_used"] = 0
@@ -290,7 +1193,702 @@ def check_user(user):
         USERS[uid]["photos_used"] = 0
         USERS[uid]["img_gen_used"] = 0 
         USERS[uid]["last_active_month"] = current_month
-        save_json(DB_FILE, USERS)
+        USERS.save(uid)
+
+# --- CONTEXT ---
+_encoding = None
+
+def load_encoding():
+    """Imports tiktoken and loads its encoding, which may download it; call from a thread, never on the event loop."""
+    global _encoding
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, estimating tokens from bytes: {e}")
+
+def count_tokens(text):
+    """Token count via tiktoken once load_encoding has run, otherwise a UTF-8 byte estimate (~4 bytes/token)."""
+    if _encoding: return len(_encoding.encode(text))
+    return len(text.encode("utf-8")) // 4 + 1
+
+IMAGE_TOKENS = 765  # high-detail 1024px image
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+def estimate_tokens(messages):
+    """Prompt size estimate used for TPM accounting."""
+    total = 0
+    for m in messages:
+        if isinstance(m["content"], str): total += count_tokens(m["content"]) + 4
+        else: total += sum(count_tokens(part["text"]) if part["type"] == "text" else LOW_DETAIL_IMAGE_TOKENS if part["image_url"].get("detail") == "low" else IMAGE_TOKENS for part in m["content"]) + 4
+    return total
+
+def entry_tokens(entry):
+    """Token cost of a history entry, cached on the entry itself."""
+    if "tokens" not in entry: entry["tokens"] = count_tokens(entry["content"]) + 4
+    return entry["tokens"]
+
+def build_context(history, budget):
+    """Packs the newest whole turns (user message + its reply) that fit in `budget` tokens.
+
+    Returns (messages, overflow) where overflow is the prefix of history that did not fit.
+    """
+    turns = []
+    for m in history:
+        if m["role"] == "assistant" and turns and turns[-1][-1]["role"] == "user": turns[-1].append(m)
+        else: turns.append([m])
+    kept, used = 0, 0
+    for turn in reversed(turns):
+        cost = sum(entry_tokens(m) for m in turn)
+        if used + cost > budget: break
+        kept += 1
+        used += cost
+    cut = sum(len(turn) for turn in turns[:len(turns) - kept])
+    messages = [{"role": m["role"], "content": m["content"]} for m in history[cut:]]
+    return messages, history[:cut]
+
+def drop_backlog(history, overflow, limit):
+    """Deletes the oldest overflow entries until the rest fits in `limit` tokens, so history stays bounded while summaries fail.
+
+    Returns the overflow that is left.
+    """
+    used, keep = 0, 0
+    for m in reversed(overflow):
+        used += entry_tokens(m)
+        if used > limit: break
+        keep += 1
+    drop = len(overflow) - keep
+    if drop: del history[:drop]
+    return overflow[drop:]
+
+CODE_RE = re.compile(r"```|^\s*(?:def|class|import|from|function|const|let|var|public|#include|SELECT)\b|[{};]\s*$|=>", re.MULTILINE | re.IGNORECASE)
+# Short prompts that still ask for real work (en/ru/uz stems): writing, explaining, solving, comparing...
+TASK_RE = re.compile(r"(?<!\w)(?:write|explain|essay|analy|compare|prove|solve|calculat|plan|summari|translat|"
+                     r"напиш|объясн|сочинен|анализ|сравн|докаж|реш|посчита|рассчита|спланир|перевед|"
+                     r"yoz|tushuntir|insho|tahlil|solishtir|isbotla|yech|hisobla|reja|tarjima)", re.IGNORECASE)
+
+def choose_model(tier, text, images, excerpts, context_tokens):
+    """Picks the model for a chat turn and why: the tier's model, or its cascade model when the turn is easy."""
+    model = TIER_MODELS[tier]
+    policy = MODEL_CASCADE.get(tier) if MODEL_CASCADE_ENABLED else None
+    if not policy or policy[0] == model: return model, "tier"
+    cheap, max_tokens, max_context = policy
+    if images: return model, "images"
+    if excerpts: return model, "documents"
+    if CODE_RE.search(text): return model, "code"
+    if TASK_RE.search(text): return model, "task"
+    if count_tokens(text) > max_tokens: return model, "long"
+    if context_tokens > max_context: return model, "context"
+    return cheap, "simple"
+
+def record_usage(tier, model, usage):
+    """Counts tokens and estimated spend for one completion."""
+    if not usage: return
+    METRICS.inc("bot_tokens_total", usage.prompt_tokens, tier=tier, model=model, kind="prompt")
+    METRICS.inc("bot_tokens_total", usage.completion_tokens, tier=tier, model=model, kind="completion")
+    p_in, p_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    METRICS.inc("bot_cost_usd_total", (usage.prompt_tokens * p_in + usage.completion_tokens * p_out) / 1e6, tier=tier, model=model)
+
+FOLDING = set()  # users with a summary update in flight
+
+async def fold_into_summary(uid, entries):
+    """Merges turns that fell out of the context budget into the user's rolling summary.
+
+    Runs as its own task and takes the user's lock only to store the result. The turns leave history only
+    then, and only if history and summary did not change meanwhile; if the call fails they stay for the next try.
+    """
+    try:
+        rec = await USERS.fetch(uid)
+        if not rec: return
+        tier, prev = rec["tier"], rec.get("summary")
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in entries)
+        try:
+            resp = await OPENAI_POOL.run(tier, SUMMARY_MODEL, count_tokens(transcript) + count_tokens(prev or "") + SUMMARY_MAX_TOKENS,
+                client.chat.completions.create, max_tokens=SUMMARY_MAX_TOKENS,
+                messages=[
+                    {"role": "system", "content": "You maintain a compact running summary of a chat between a user and an assistant. Merge the new turns into the existing summary, keeping names, facts, decisions and open questions. Reply with the updated summary only."},
+                    {"role": "user", "content": f"SUMMARY:\n{prev or '(empty)'}\n\nNEW TURNS:\n{transcript}"}
+                ]
+            )
+        except Exception as e:
+            return logger.error(f"Summary update failed for {uid}: {e}")
+        record_usage(tier, SUMMARY_MODEL, resp.usage)
+        async with USERS.lock(uid):
+            rec = USERS.get(uid)
+            if not rec or rec.get("summary") != prev or rec["history"][:len(entries)] != entries: return
+            rec["summary"] = resp.choices[0].message.content
+            del rec["history"][:len(entries)]
+            USERS.save(uid)
+    finally:
+        FOLDING.discard(uid)
+
+# --- IMAGES ---
+class LRUCache:
+    """Least-recently-used cache bounded by the total size of its values (as measured by `sizeof`)."""
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        if key not in self.items: return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.pop(key)
+        cost = self.sizeof(value)
+        if cost > self.max_size: return
+        self.items[key] = value
+        self.size += cost
+        while self.size > self.max_size:
+            _, old = self.items.popitem(last=False)
+            self.size -= self.sizeof(old)
+
+    def pop(self, key):
+        if key in self.items: self.size -= self.sizeof(self.items.pop(key))
+
+IMAGE_CACHE = LRUCache(IMAGE_CACHE_MB * 1024 * 1024)
+
+@functools.lru_cache(maxsize=1)
+def pil_image():
+    """PIL's Image module, imported on first use (in a worker thread); None without Pillow."""
+    try: from PIL import Image
+    except ImportError: return None
+    return Image
+
+def _encode_image(path, max_side=None):
+    Image = pil_image() if max_side else None
+    if Image:
+        with Image.open(path) as img:
+            if max(img.size) > max_side:
+                img.thumbnail((max_side, max_side))
+                buf = io.BytesIO()
+                img.convert("RGB").save(buf, "JPEG", quality=85)
+                return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+    with open(path, "rb") as f:
+        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("ascii")
+
+async def image_data_url(path, max_side=None):
+    """Base64 data URL for a stored photo (optionally downscaled), encoded once and then served from IMAGE_CACHE."""
+    key = (path, max_side)
+    url = IMAGE_CACHE.get(key)
+    if url is None:
+        url = await asyncio.to_thread(_encode_image, path, max_side)
+        IMAGE_CACHE.put(key, url)
+    return url
+
+class MediaStore:
+    """Uploaded photos on disk, named by Telegram's file_unique_id so a picture is stored once for all users.
+
+    Every use refreshes a file's mtime; `gc()` deletes files unused for `ttl` seconds and then the oldest
+    ones while the directory is over `max_bytes`. Deleted photos are fetched again by file_id when needed.
+    """
+    def __init__(self, root, ttl, max_bytes):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.fetching = {}  # path -> download task, so simultaneous uploads of one file download it once
+        self.last_gc = 0
+
+    def path(self, unique_id):
+        return os.path.join(self.root, f"{unique_id}.jpg")
+
+    async def fetch(self, bot, file_id, path):
+        """Makes sure `path` holds the photo, downloading it only if nobody has stored it yet."""
+        if os.path.exists(path):
+            with contextlib.suppress(OSError): os.utime(path)
+            return
+        task = self.fetching.get(path)
+        if task is None:
+            task = self.fetching[path] = asyncio.ensure_future(self._download(bot, file_id, path))
+            task.add_done_callback(lambda _: self.fetching.pop(path, None))
+        await asyncio.shield(task)
+
+    async def _download(self, bot, file_id, path):
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.part"
+        os.makedirs(self.root, exist_ok=True)  # here rather than at import, which pool workers repeat
+        try:
+            with METRICS.timer("bot_stage_seconds", stage="tg_download"):
+                f = await bot.get_file(file_id)
+                await f.download_to_drive(tmp)
+            await shrink_photo(tmp)
+            os.replace(tmp, path)
+        finally:
+            with contextlib.suppress(OSError): os.remove(tmp)
+        if time.monotonic() - self.last_gc > MEDIA_GC_INTERVAL:
+            self.last_gc = time.monotonic()
+            asyncio.get_running_loop().run_in_executor(None, self.gc)
+
+    def gc(self):
+        """Deletes expired photos, then the least recently used ones until the store fits its quota."""
+        now = time.time()
+        files, removed = [], 0
+        for e in os.scandir(self.root):
+            try: st = e.stat()
+            except OSError: continue
+            if not e.is_file(): continue
+            partial = e.name.endswith(".part")  # in-flight download unless it is an hour old
+            if st.st_mtime < now - (3600 if partial else self.ttl):
+                with contextlib.suppress(OSError): os.remove(e.path); removed += 1
+            elif not partial: files.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes: break
+            with contextlib.suppress(OSError): os.remove(path); removed += 1
+            total -= size
+        if removed: logger.info(f"Media GC removed {removed} files, {total / 2**20:.1f} MB kept")
+        METRICS.inc("bot_media_gc_removed_total", removed)
+
+MEDIA = MediaStore(MEDIA_DIR, MEDIA_TTL_HOURS * 3600, MEDIA_MAX_MB * 1024 * 1024)
+
+def photo_entry(p):
+    """temp_photos entries are {"path", "file_id"}; older records stored bare paths."""
+    return p if isinstance(p, dict) else {"path": p, "file_id": None}
+
+async def local_photo(bot, p):
+    """Local path of a remembered photo, re-downloaded by file_id when it was collected or this worker doesn't have it."""
+    entry = photo_entry(p)
+    if entry["file_id"]:
+        try: await MEDIA.fetch(bot, entry["file_id"], entry["path"])
+        except Exception as e: logger.warning(f"Could not fetch photo {entry['file_id']}: {e}")
+    return entry["path"] if os.path.exists(entry["path"]) else None
+
+def _shrink_photo(path):
+    Image = pil_image()
+    if not Image: return
+    with Image.open(path) as img:
+        if max(img.size) <= PHOTO_MAX_SIDE: return
+        img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        img.convert("RGB").save(path, "JPEG", quality=85)
+
+async def shrink_photo(path):
+    """Downscales an uploaded photo in place so its longest side is at most PHOTO_MAX_SIDE."""
+    if not PHOTO_MAX_SIDE: return
+    try: await asyncio.to_thread(_shrink_photo, path)
+    except Exception as e: logger.warning(f"Could not resize {path}: {e}")
+
+# --- RESPONSE & FILE CACHES ---
+NAME_SLOT = "\x00name\x00"
+COMPLETION_CACHE = LRUCache(RESPONSE_CACHE_MB * 1024 * 1024, sizeof=lambda v: len(v[1]))
+FILE_CACHE = LRUCache(FILE_CACHE_MB * 1024 * 1024)
+
+def normalize_prompt(text):
+    return " ".join(text.lower().split()).rstrip("!?. ")
+
+def response_cache_key(model, sys_prompt, name, summary, past, text):
+    """Content address of a completion: model, system prompt and the whole context sent, with the user's name masked out.
+
+    Returns None when the name is too short to mask safely in the reply, or when the context is too long to be shared.
+    """
+    if len(name) < 3 or len(past) > RESPONSE_CACHE_CONTEXT: return None
+    context = json.dumps([summary] + past, ensure_ascii=False).replace(name, NAME_SLOT)
+    parts = [model, sys_prompt.replace(name, NAME_SLOT), hashlib.sha256(context.encode()).hexdigest(), normalize_prompt(text)]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+def cached_response(key, name):
+    hit = COMPLETION_CACHE.get(key)
+    if not hit: return None
+    if hit[0] < time.time():
+        COMPLETION_CACHE.pop(key)
+        return None
+    return hit[1].replace(NAME_SLOT, name)
+
+def cache_response(key, reply, name):
+    COMPLETION_CACHE.put(key, (time.time() + RESPONSE_CACHE_TTL, reply.replace(name, NAME_SLOT)))
+
+# --- VISION ROUTING ---
+# Word stems that point at the attached photos, for every TEXTS language; matched at word starts
+VISION_KEYWORDS = {
+    "en": ["look", "see", "image", "photo", "pic", "screen", "solve", "analy", "extract", "read", "describe", "translate", "attached", "above", "chart", "diagram", "handwrit"],
+    "ru": ["фото", "картин", "изображ", "снимок", "скрин", "посмотр", "смотри", "видишь", "опиш", "реши", "прочит", "прочт", "распозна", "анализ", "переведи", "график", "схем"],
+    "uz": ["rasm", "surat", "foto", "skrin", "qara", "ko'r", "tasvir", "yech", "o'qi", "tahlil", "tarjima", "grafik", "sxema"]
+}
+# Requests that need fine detail (small text, formulas) get high-detail images; the rest get low detail
+VISION_FINE_KEYWORDS = {
+    "en": ["read", "extract", "solve", "text", "translate", "handwrit", "formula", "code", "table", "number"],
+    "ru": ["прочит", "прочт", "реши", "текст", "переведи", "распозна", "формул", "код", "таблиц", "цифр", "числ"],
+    "uz": ["o'qi", "yech", "matn", "tarjima", "formula", "kod", "jadval", "raqam", "son"]
+}
+
+def _stems_re(stems):
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(w) for words in stems.values() for w in words) + ")", re.IGNORECASE)
+
+VISION_KEYWORDS_RE = _stems_re(VISION_KEYWORDS)
+VISION_FINE_RE = _stems_re(VISION_FINE_KEYWORDS)
+VISION_VERDICTS = LRUCache(4096, sizeof=lambda v: 1)
+VISION_CLASSIFIER_PROMPT = "The user attached photos earlier in this chat. Reply 'yes' if their next message needs those photos to be answered, otherwise 'no'."
+
+async def classify_vision(tier, text):
+    """Small-model yes/no on whether a message is about the attached photos; verdicts are cached per normalized text."""
+    key = normalize_prompt(text)
+    verdict = VISION_VERDICTS.get(key)
+    if verdict is None:
+        messages = [{"role": "system", "content": VISION_CLASSIFIER_PROMPT}, {"role": "user", "content": text[:500]}]
+        resp = await OPENAI_POOL.run(tier, SUMMARY_MODEL, estimate_tokens(messages) + 1, client.chat.completions.create, messages=messages, max_tokens=1)
+        record_usage(tier, SUMMARY_MODEL, resp.usage)
+        verdict = (resp.choices[0].message.content or "").strip().lower().startswith("y")
+        VISION_VERDICTS.put(key, verdict)
+    return verdict
+
+async def route_vision(uid, text):
+    """Decides whether this turn sends the remembered photos, and at which detail.
+
+    Returns (detail, reason) with detail None when the photos stay out of the request. Cheap signals go
+    first: the first turn after an upload always includes them, then keywords in any language, then the
+    optional classifier.
+    """
+    rec = USERS[uid]
+    photos = rec.get("temp_photos") or []
+    if not photos: return None, "no_photos"
+    if rec.get("img_turn_count", 0) <= 1: reason = "recent"
+    elif VISION_KEYWORDS_RE.search(text): reason = "keyword"
+    elif VISION_CLASSIFIER:
+        try: reason = "classifier" if await classify_vision(rec["tier"], text) else None
+        except Exception as e:
+            logger.warning(f"Vision classifier failed for {uid}: {e}")
+            reason = None
+    else: reason = None
+    if reason is None: return None, "skipped"
+    if VISION_DETAIL in ("low", "high"): return VISION_DETAIL, reason
+    return ("high" if VISION_FINE_RE.search(text) else "low"), reason
+
+# --- WORKER POOL ---
+_worker_pool = None
+
+def get_worker_pool():
+    """Process pool for CPU-bound work (document parsing, PDF/DOCX rendering) kept off the event loop.
+
+    Jobs come from workers.py; this module only builds its state on first use, so a worker that re-imports it opens nothing.
+    Workers are not forked from the bot: a fork taken while another thread holds an import lock hangs the child.
+    """
+    global _worker_pool
+    if _worker_pool is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _worker_pool = ProcessPoolExecutor(max_workers=WORKER_PROCESSES, mp_context=multiprocessing.get_context(method))
+    return _worker_pool
+
+# --- FILE EXPORT ---
+def export_body(content):
+    """All fenced code blocks joined together, or the whole reply when it has none."""
+    blocks = re.findall(r"```[\w+-]*\n(.*?)```", content, re.DOTALL)
+    return "\n\n".join(block.rstrip("\n") for block in blocks) if blocks else content
+
+@functools.lru_cache(maxsize=1)
+def find_pdf_font():
+    for path in [PDF_FONT] + PDF_FONT_CANDIDATES:
+        if path and os.path.exists(path): return path
+    return None
+
+# --- DOCUMENTS ---
+def chunk_text(text, size):
+    """Splits text into chunks of roughly `size` characters on line boundaries."""
+    chunks, cur, n = [], [], 0
+    for line in text.split("\n"):
+        for piece in (line[i:i + size] for i in range(0, len(line), size)):
+            if cur and n + len(piece) > size:
+                chunks.append("\n".join(cur))
+                cur, n = [], 0
+            cur.append(piece)
+            n += len(piece) + 1
+    if cur: chunks.append("\n".join(cur))
+    return chunks
+
+class DocIndex:
+    """Full-text index of uploaded documents (SQLite FTS5, ranked by BM25) in one table for all users.
+
+    `uid` is an indexed column, so every query is scoped with a `uid:N` column filter and only reads that
+    user's postings; it has zero weight in the ranking.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        """Opens the file on first use (callers hold self.lock), so importing the module touches nothing."""
+        if self.conn: return
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS doc_chunks USING fts5(content, uid, file UNINDEXED, tokenize='unicode61 remove_diacritics 2')")
+        self._import_legacy()
+        self.conn.commit()
+
+    def _import_legacy(self):
+        """One-time move of the old `chunks` table (uid unindexed) and per-user `chunks_N` tables into doc_chunks."""
+        tables = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND (name = 'chunks' OR (name GLOB 'chunks_[0-9]*' AND name NOT GLOB 'chunks_*_*'))")]
+        for table in tables:
+            uid = "uid" if table == "chunks" else int(table[len("chunks_"):])  # names come from sqlite_master, uids are integers
+            self.conn.execute(f"INSERT INTO doc_chunks (content, uid, file) SELECT content, {uid}, file FROM {table}")
+            self.conn.execute(f"DROP TABLE {table}")
+        if tables: logger.info(f"Moved {len(tables)} legacy document tables into doc_chunks")
+
+    @staticmethod
+    def _owner(uid):
+        return f'uid:"{int(uid)}"'
+
+    def _delete(self, uid, file=None):
+        rows = "SELECT rowid FROM doc_chunks WHERE doc_chunks MATCH ?" + (" AND file = ?" if file is not None else "")
+        self.conn.execute(f"DELETE FROM doc_chunks WHERE rowid IN ({rows})", (self._owner(uid),) + ((file,) if file is not None else ()))
+
+    def add(self, uid, file, text):
+        """Replaces the indexed chunks of `file` for this user. Returns the number of chunks."""
+        chunks = chunk_text(text, DOC_CHUNK_CHARS)
+        with self.lock:
+            self._open()
+            self._delete(uid, file)
+            self.conn.executemany("INSERT INTO doc_chunks (content, uid, file) VALUES (?, ?, ?)", ((c, int(uid), file) for c in chunks))
+            self.conn.commit()
+        return len(chunks)
+
+    def clear(self, uid):
+        with self.lock:
+            self._open()
+            self._delete(uid)
+            self.conn.commit()
+
+    def search(self, uid, query, k):
+        """Top-k (file, chunk) pairs of this user's documents for any word of `query`."""
+        words = {w for w in re.findall(r"\w+", query.lower()) if len(w) > 1}
+        if not words: return []
+        match = f"{self._owner(uid)} AND content:(" + " OR ".join(f'"{w}"' for w in words) + ")"
+        with self.lock:
+            self._open()
+            return self.conn.execute("SELECT file, content FROM doc_chunks WHERE doc_chunks MATCH ? ORDER BY bm25(doc_chunks, 1.0, 0.0) LIMIT ?", (match, k)).fetchall()
+
+DOC_INDEX = DocIndex(DOCS_DB)
+
+# --- IMAGE JOBS ---
+IMAGE_SIZES = {"1:1": "1024x1024", "16:9": "1792x1024", "9:16": "1024x1792"}
+IMAGE_OPTION_RE = re.compile(r"(?<!\S)(?:[x×]([1-4])|(1:1|16:9|9:16))(?!\S)", re.IGNORECASE)
+
+def parse_image_request(text):
+    """Splits "a red fox x3 16:9" into the prompt, the number of variants and the DALL-E size."""
+    n, size = 1, IMAGE_SIZES["1:1"]
+    for count, ratio in IMAGE_OPTION_RE.findall(text):
+        if count: n = int(count)
+        if ratio: size = IMAGE_SIZES[ratio]
+    return IMAGE_OPTION_RE.sub("", text).strip() or text, n, size
+
+class ImageJobs:
+    """Background image generation: handlers enqueue a job and return, `workers` tasks run the jobs.
+
+    A job starts only while its tier has fewer than `tier_limits[tier]` jobs running; later jobs of other
+    tiers are picked instead of waiting behind it. Each user has at most one job queued or running.
+    """
+    def __init__(self, workers, tier_limits):
+        self.workers = workers
+        self.tier_limits = tier_limits
+        self.waiting = deque()
+        self.running = {}
+        self.users = set()
+        self.changed = asyncio.Condition()
+        self.tasks = []
+
+    def busy(self, uid):
+        return uid in self.users
+
+    def position(self):
+        """Place in line a job submitted now would get."""
+        return len(self.waiting) + 1
+
+    async def submit(self, job):
+        if not self.tasks: self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.users.add(job["uid"])
+        async with self.changed:
+            self.waiting.append(job)
+            self.changed.notify_all()
+
+    def _next(self):
+        for job in self.waiting:
+            if self.running.get(job["tier"], 0) < self.tier_limits.get(job["tier"], 1): return job
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self.changed:
+                while (job := self._next()) is None: await self.changed.wait()
+                self.waiting.remove(job)
+                self.running[job["tier"]] = self.running.get(job["tier"], 0) + 1
+            try:
+                await USERS.fetch(job["uid"])  # replies look up the user's language
+                await generate_images(job)
+            except Exception as e:
+                METRICS.inc("bot_errors_total", where="imggen", type=type(e).__name__)
+                logger.error(f"Image job for {job['uid']} failed: {e}")
+                with contextlib.suppress(Exception): await job["bot"].send_message(job["uid"], get_text(job["uid"], "imggen_error"))
+            finally:
+                await self._refund(job)
+                self.users.discard(job["uid"])
+                async with self.changed:
+                    self.running[job["tier"]] -= 1
+                    self.changed.notify_all()
+
+    async def _refund(self, job):
+        """Gives back the variants reserved at enqueue that were not delivered, whatever stopped the job."""
+        unspent = job["n"] - job.get("sent", 0)
+        if not unspent: return
+        try:
+            async with USERS.lock(job["uid"]): await USERS.incr(job["uid"], "img_gen_used", -unspent)
+        except Exception as e: logger.error(f"Refund of {unspent} images for {job['uid']} failed: {e}")
+
+    def stats(self):
+        return {"waiting": len(self.waiting), "running": dict(self.running)}
+
+IMAGE_JOBS = ImageJobs(IMAGE_WORKERS, TIER_IMG_CONCURRENCY)
+
+async def generate_images(job):
+    """Generates a job's variants in parallel as base64 (nothing to download) and sends them as one album.
+
+    Sets job["sent"] once the images are delivered; the worker refunds the rest of the reserved variants.
+    """
+    uid, tier, size, bot = job["uid"], job["tier"], job["size"], job["bot"]
+    t = lambda k, **kwargs: get_text(uid, k, **kwargs)
+    with contextlib.suppress(BadRequest): await job["status"].edit_text(t("imggen_wait"))
+    await bot.send_chat_action(chat_id=uid, action="upload_photo")
+    results = await asyncio.gather(*(
+        OPENAI_POOL.run(tier, "dall-e-3", 0, client.images.generate, prompt=job["prompt"], size=size, quality="standard", n=1, response_format="b64_json")
+        for _ in range(job["n"])
+    ), return_exceptions=True)
+    images = [base64.b64decode(r.data[0].b64_json) for r in results if not isinstance(r, BaseException)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for e in errors:
+        METRICS.inc("bot_errors_total", where="imggen", type=type(e).__name__)
+        logger.error(f"DALL-E failed for {uid}: {e}")
+    with contextlib.suppress(BadRequest): await job["status"].delete()
+    if not images: return await bot.send_message(uid, t("ai_busy") if isinstance(errors[0], rate_limit_error()) else t("imggen_error"))
+    METRICS.inc("bot_images_total", len(images), tier=tier, model="dall-e-3")
+    METRICS.inc("bot_cost_usd_total", IMAGE_PRICES[size] * len(images), tier=tier, model="dall-e-3")
+    if len(images) == 1: await bot.send_photo(uid, images[0], caption=t("imggen_done"))
+    else: await bot.send_media_group(uid, [InputMediaPhoto(img, caption=t("imggen_done") if i == 0 else None) for i, img in enumerate(images)])
+    job["sent"] = len(images)
+
+# --- FAN-OUT ---
+class FanOut:
+    """Sends one message to many chats concurrently, paced to at most `rate` messages per second.
+
+    A flood wait (RetryAfter) pushes back every pending send of the fan-out, then the message is retried.
+    `results` maps each chat id to "ok" or the class name of its last error (Forbidden: the user blocked the bot).
+    """
+    def __init__(self, bot, rate=FANOUT_RATE, concurrency=FANOUT_CONCURRENCY, retries=FANOUT_RETRIES):
+        self.bot = bot
+        self.rate = rate
+        self.concurrency = concurrency
+        self.retries = retries
+        self.next_slot = 0.0
+        self.results = {}
+
+    async def _pace(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + 1 / self.rate
+        if slot > now: await asyncio.sleep(slot - now)
+
+    async def _deliver(self, chat_id, message):
+        for attempt in range(self.retries + 1):
+            await self._pace()
+            try:
+                await self.bot.send_message(chat_id=chat_id, **message)
+                self.results[chat_id] = "ok"
+                return
+            except RetryAfter as e:
+                self.next_slot = max(self.next_slot, time.monotonic() + e.retry_after)
+                self.results[chat_id] = "RetryAfter"
+            except (TimedOut, NetworkError) as e:
+                self.results[chat_id] = type(e).__name__
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                self.results[chat_id] = type(e).__name__
+                return
+
+    async def send(self, chat_ids, **message):
+        sem = asyncio.Semaphore(self.concurrency)
+        async def one(chat_id):
+            async with sem: await self._deliver(chat_id, message)
+        await asyncio.gather(*(one(chat_id) for chat_id in chat_ids))
+        for status in self.results.values(): METRICS.inc("bot_fanout_messages_total", status=status)
+        return self.results
+
+    def summary(self):
+        counts = {}
+        for status in self.results.values(): counts[status] = counts.get(status, 0) + 1
+        return counts
+
+TG_MSG_LIMIT = 4000
+STREAM_CURSOR = " ▌"
+
+async def stream_reply(message, stream):
+    """Relays a completion stream into Telegram, editing the reply at most every STREAM_EDIT_INTERVAL seconds.
+
+    Text beyond TG_MSG_LIMIT continues in follow-up messages. Returns (full reply text, usage or None). If the
+    stream breaks, what was shown is left without the cursor and the error propagates.
+    """
+    parts, msgs, shown = [], {}, {}
+    last_edit = 0.0
+    usage = None
+
+    async def render(final):
+        text = "".join(parts)
+        pages = [text[i:i + TG_MSG_LIMIT] for i in range(0, len(text), TG_MSG_LIMIT)]
+        for i, page in enumerate(pages):
+            body = page if final or i < len(pages) - 1 else page + STREAM_CURSOR
+            while shown.get(i) != body:
+                try:
+                    with METRICS.timer("bot_stage_seconds", stage="tg_send"):
+                        if i in msgs: await msgs[i].edit_text(body)
+                        else: msgs[i] = await message.reply_text(body)
+                    shown[i] = body
+                except RetryAfter as e:
+                    if not final: return
+                    await asyncio.sleep(e.retry_after)
+                except BadRequest as e:
+                    if "not modified" not in str(e): raise
+                    shown[i] = body
+
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None): usage = chunk.usage
+            if not chunk.choices: continue
+            delta = chunk.choices[0].delta.content
+            if not delta: continue
+            parts.append(delta)
+            if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                await render(final=False)
+                last_edit = time.monotonic()
+    except Exception:
+        if msgs:
+            try: await render(final=True)
+            except Exception as e: logger.warning(f"Could not finish the partial reply: {e}")
+        raise
+    await render(final=True)
+    return "".join(parts), usage
+
+def instrumented(handler):
+    """Records the handler's latency and counts exceptions escaping it by type."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        start = time.monotonic()
+        try: return await handler(update, context)
+        except Exception as e:
+            METRICS.inc("bot_errors_total", where=handler.__name__, type=type(e).__name__)
+            raise
+        finally: METRICS.observe("bot_handler_seconds", time.monotonic() - start, handler=handler.__name__)
+    return wrapper
+
+def per_user(handler):
+    """Runs a handler while holding the sender's record lock so concurrent workers can't interleave updates.
+
+    Albums the sender is still uploading are ingested first, keeping their updates in order.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if not user: return await handler(update, context)
+        async with USERS.lock(user.id):
+            if PENDING_ALBUMS: await flush_pending_albums(update, context)
+            return await handler(update, context)
+    return wrapper
 
 # --- HANDLERS ---
 async def user_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -308,13 +1906,13 @@ async def user_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     contact = update.message.contact
     if contact.user_id != user.id: return
     USERS[user.id]["phone"] = contact.phone_number
-    save_json(DB_FILE, USERS)
+    USERS.save(user.id)
     await update.message.reply_text(AUTH_TEXTS["wait"], reply_markup=ReplyKeyboardMarkup([], resize_keyboard=True))
     if admin_bot_app:
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Allow", callback_data=f"ok_{user.id}"), InlineKeyboardButton("❌ Deny", callback_data=f"no_{user.id}")], [InlineKeyboardButton("🚫 Block", callback_data=f"block_{user.id}")]])
-        for admin_id in ADMINS:
-            try: await admin_bot_app.bot.send_message(chat_id=admin_id, text=f"🔔 **Req:** {user.first_name} ({user.id})", reply_markup=kb)
-            except: pass
+        results = await FanOut(admin_bot_app.bot).send(list(await USERS.admins()), text=f"🔔 **Req:** {user.first_name} ({user.id})", reply_markup=kb)
+        failed = {admin_id: status for admin_id, status in results.items() if status != "ok"}
+        if failed: logger.warning(f"Approval request for {user.id} not delivered to admins: {failed}")
 
 # --- PAYMENT HANDLERS ---
 async def tier_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -405,93 +2003,106 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     
     # UPDATE USER
     USERS[uid]["tier"] = plan_type
-    save_json(DB_FILE, USERS)
+    await USERS.commit(uid)
     
     t = lambda k, **kwargs: get_text(uid, k, **kwargs)
     await update.message.reply_text(t("pay_thanks", tier=plan_type))
 
 
+# --- MENU BUTTONS ---
+async def button_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not USERS[uid].get("last_bot_text"): return await update.message.reply_text(get_text(uid, "no_text"))
+    await update.message.reply_text(get_text(uid, "choose_fmt"), reply_markup=FORMAT_KEYBOARD)
+
+async def button_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    USERS[uid]["temp_photos"] = []
+    USERS[uid]["history"] = []
+    USERS[uid]["summary"] = None
+    USERS[uid]["docs"] = []
+    await asyncio.to_thread(DOC_INDEX.clear, uid)
+    USERS[uid]["img_turn_count"] = 0
+    USERS[uid]["waiting_for_img"] = False
+    USERS.save(uid)
+    await update.message.reply_text(get_text(uid, "cleared"), reply_markup=get_main_keyboard(uid))
+
+async def button_analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(get_text(update.effective_user.id, "send_photo_prompt"))
+
+async def button_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(get_text(update.effective_user.id, "listening"))
+
+async def button_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(get_text(update.effective_user.id, "choose_lang"), reply_markup=LANG_KEYBOARD)
+
+async def lang_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    USERS[uid]["lang"] = LANG_BUTTONS[update.message.text]
+    USERS.save(uid)
+    await update.message.reply_text(get_text(uid, "lang_set"), reply_markup=get_main_keyboard(uid))
+
+async def button_uploads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    photos = USERS[uid].get("temp_photos", [])
+    if not photos: return await update.message.reply_text(get_text(uid, "no_imgs"))
+    try:
+        media = []
+        for e in map(photo_entry, photos):
+            if e["file_id"]: media.append(InputMediaPhoto(e["file_id"]))  # resent by id, nothing is uploaded
+            elif os.path.exists(e["path"]):
+                with open(e["path"], "rb") as f: media.append(InputMediaPhoto(f.read()))
+        for i in range(0, len(media), 10): await update.message.reply_media_group(media[i:i + 10])  # Telegram's album limit
+    except: await update.message.reply_text("Error sending photos.")
+
+async def button_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    tier = USERS[uid]["tier"]
+    await update.message.reply_text(get_text(uid, "usage_msg",
+        name=USERS[uid]["name"],
+        tier=tier,
+        model=TIER_MODELS.get(tier, "Unknown"),
+        used=USERS[uid]["used"],
+        limit=TIER_LIMITS[tier],
+        p_used=USERS[uid]["photos_used"],
+        p_limit=TIER_PHOTO_LIMITS[tier],
+        g_used=USERS[uid]["img_gen_used"],
+        g_limit=TIER_IMG_GEN_LIMITS[tier]
+    ), parse_mode="Markdown")
+
+async def button_imggen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    tier = USERS[uid]["tier"]
+    if USERS[uid]["img_gen_used"] >= TIER_IMG_GEN_LIMITS[tier]:
+        return await update.message.reply_text(get_text(uid, "imggen_limit", used=USERS[uid]["img_gen_used"], limit=TIER_IMG_GEN_LIMITS[tier]))
+    USERS[uid]["waiting_for_img"] = True
+    USERS.save(uid)
+    await update.message.reply_text(get_text(uid, "imggen_prompt"))
+
+BUTTON_ACTIONS = {
+    "btn_file": button_file,
+    "btn_clear": button_clear,
+    "btn_analyze": button_analyze,
+    "btn_chat": button_chat,
+    "btn_lang": button_lang,
+    "lang_choice": lang_choice,
+    "btn_tier": tier_button_handler,
+    "btn_uploads": button_uploads,
+    "btn_usage": button_usage,
+    "btn_imggen": button_imggen
+}
+
 async def user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
     check_user(user)
     if not USERS[uid]["approved"]: return await user_start(update, context)
 
-    text = update.message.text
+    text = update.message.text or update.message.caption  # photo captions are routed here as the prompt
     t = lambda k, **kwargs: get_text(uid, k, **kwargs)
 
-    # --- BUTTONS ---
-    if text == t("btn_file"):
-        if not USERS[uid].get("last_bot_text"):
-            await update.message.reply_text(t("no_text"))
-            return
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("📝 Word", callback_data="fmt_docx"), InlineKeyboardButton("📕 PDF", callback_data="fmt_pdf")], [InlineKeyboardButton("🐍 Python", callback_data="fmt_py"), InlineKeyboardButton("📄 Text", callback_data="fmt_txt")]])
-        await update.message.reply_text(t("choose_fmt"), reply_markup=kb)
-        return
-
-    if text == t("btn_clear"):
-        USERS[uid]["temp_photos"] = []
-        USERS[uid]["history"] = []
-        USERS[uid]["img_turn_count"] = 0
-        USERS[uid]["waiting_for_img"] = False
-        save_json(DB_FILE, USERS)
-        await update.message.reply_text(t("cleared"), reply_markup=get_main_keyboard(uid))
-        return
-
-    if text == t("btn_analyze"): return await update.message.reply_text(t("send_photo_prompt"))
-    if text == t("btn_chat"): return await update.message.reply_text(t("listening"))
-    
-    if text == t("btn_lang"):
-        kb = ReplyKeyboardMarkup([["English 🇺🇸", "Russian 🇷🇺", "Uzbek 🇺🇿"]], resize_keyboard=True)
-        return await update.message.reply_text(get_text(uid, "choose_lang"), reply_markup=kb)
-    if text in ["English 🇺🇸", "Russian 🇷🇺", "Uzbek 🇺🇿"]:
-        lang_map = {"English 🇺🇸": "en", "Russian 🇷🇺": "ru", "Uzbek 🇺🇿": "uz"}
-        USERS[uid]["lang"] = lang_map[text]
-        save_json(DB_FILE, USERS)
-        return await update.message.reply_text(get_text(uid, "lang_set"), reply_markup=get_main_keyboard(uid))
-    
-    # --- UPDATED TIER HANDLER ---
-    if text == t("btn_tier"):
-        await tier_button_handler(update, context)
-        return
-    
-    if text == t("btn_uploads"):
-        photos = USERS[uid].get("temp_photos", [])
-        if photos:
-            try:
-                media = [InputMediaPhoto(open(p, "rb")) for p in photos if os.path.exists(p)]
-                if media: await update.message.reply_media_group(media)
-            except: await update.message.reply_text("Error sending photos.")
-        else: await update.message.reply_text(t("no_imgs"))
-        return
-
-    if text == t("btn_usage"):
-        tier = USERS[uid]["tier"]
-        model = TIER_MODELS.get(tier, "Unknown")
-        await update.message.reply_text(t("usage_msg", 
-            name=USERS[uid]["name"], 
-            tier=tier,
-            model=model,
-            used=USERS[uid]["used"], 
-            limit=TIER_LIMITS[tier],
-            p_used=USERS[uid]["photos_used"],
-            p_limit=TIER_PHOTO_LIMITS[tier],
-            g_used=USERS[uid]["img_gen_used"],
-            g_limit=TIER_IMG_GEN_LIMITS[tier]
-        ), parse_mode="Markdown")
-        return
-
-    # --- IMAGE GENERATION TRIGGER ---
-    if text == t("btn_imggen"):
-        tier = USERS[uid]["tier"]
-        if USERS[uid]["img_gen_used"] >= TIER_IMG_GEN_LIMITS[tier]:
-            await update.message.reply_text(t("imggen_limit", used=USERS[uid]["img_gen_used"], limit=TIER_IMG_GEN_LIMITS[tier]))
-            return
-
-        USERS[uid]["waiting_for_img"] = True
-        save_json(DB_FILE, USERS)
-        await update.message.reply_text(t("imggen_prompt"))
-        return
+    action = BUTTON_ACTIONS.get(BUTTON_KEYS.get(text))
+    if action: return await action(update, context)
 
     # Check Text Limit
     limit = TIER_LIMITS.get(USERS[uid]["tier"], 100)
@@ -501,43 +2112,36 @@ async def user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- HANDLE IMAGE GENERATION PROMPT ---
     if USERS[uid].get("waiting_for_img"):
-        await update.message.reply_text(t("imggen_wait"))
-        try:
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=text,
-                size="1024x1024",
-                quality="standard",
-                n=1,
-            )
-            image_url = response.data[0].url
-            USERS[uid]["img_gen_used"] += 1 
-            USERS[uid]["waiting_for_img"] = False
-            save_json(DB_FILE, USERS)
-            await update.message.reply_photo(photo=image_url, caption=t("imggen_done"))
-        except Exception as e:
-            USERS[uid]["waiting_for_img"] = False
-            save_json(DB_FILE, USERS)
-            await update.message.reply_text(f"❌ DALL-E Error: {e}")
+        USERS[uid]["waiting_for_img"] = False
+        USERS.save(uid)
+        if IMAGE_JOBS.busy(uid): return await update.message.reply_text(t("imggen_busy"))
+        tier = USERS[uid]["tier"]
+        prompt, n, size = parse_image_request(text)
+        n = await USERS.reserve(uid, "img_gen_used", TIER_IMG_GEN_LIMITS[tier], min(n, TIER_IMG_VARIANTS.get(tier, 1)))
+        if not n: return await update.message.reply_text(t("imggen_limit", used=USERS[uid]["img_gen_used"], limit=TIER_IMG_GEN_LIMITS[tier]))
+        status = await update.message.reply_text(t("imggen_queued", pos=IMAGE_JOBS.position()))
+        await IMAGE_JOBS.submit({"uid": uid, "tier": tier, "prompt": prompt, "n": n, "size": size, "bot": context.bot, "status": status})
         return
 
     # --- NORMAL AI CHAT ---
-    if len(USERS[uid].get("temp_photos", [])) > 0:
-        USERS[uid]["img_turn_count"] += 1
-    if USERS[uid]["img_turn_count"] >= PHOTO_MEMORY_TURNS:
-        USERS[uid]["temp_photos"] = []
-        USERS[uid]["img_turn_count"] = 0
-        await update.message.reply_text(t("auto_cleared"))
-
+    # The message is charged up front (check and increment in one step) and refunded if no answer is produced
+    if not await USERS.reserve(uid, "used", limit): return await update.message.reply_text(f"❌ Message limit reached! ({limit}/{limit}). Upgrade tier.")
+    answered = False
     try:
+        if len(USERS[uid].get("temp_photos", [])) > 0:
+            USERS[uid]["img_turn_count"] += 1
+        if USERS[uid]["img_turn_count"] >= PHOTO_MEMORY_TURNS:
+            USERS[uid]["temp_photos"] = []
+            USERS[uid]["img_turn_count"] = 0
+            await update.message.reply_text(t("auto_cleared"))
+
         await context.bot.send_chat_action(chat_id=uid, action="typing")
         history = USERS[uid]["history"]
         lang = USERS[uid].get("lang", "en")
         
-        trigger_words = ['look', 'see', 'image', 'photo', 'picture', 'screen', 'solve', 'analyze', 'what', 'this', 'extract', 'read']
-        has_trigger = any(word in text.lower() for word in trigger_words)
-        has_photos = len(USERS[uid].get("temp_photos", [])) > 0
-        should_send_images = has_photos and has_trigger
+        detail, reason = await route_vision(uid, text)
+        should_send_images = detail is not None
+        METRICS.inc("bot_vision_routes_total", reason=reason, detail=detail or "none")
 
         context_instr = "CONTEXT: User attached images. Refer ONLY if asked." if should_send_images else ""
 
@@ -556,27 +2160,75 @@ async def user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         content = [{"type": "text", "text": text}]
         if should_send_images:
             for p in USERS[uid].get("temp_photos", []):
-                if os.path.exists(p):
-                    with open(p, "rb") as f:
-                        b64 = base64.b64encode(f.read()).decode('utf-8')
-                    content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}})
+                path = await local_photo(context.bot, p)
+                if path: content.append({"type": "image_url", "image_url": {"url": await image_data_url(path, VISION_LOW_SIDE if detail == "low" else None), "detail": detail}})
         
-        messages = [sys_msg] + history + [{"role": "user", "content": content}]
+        tier = USERS[uid]["tier"]
+        summary = USERS[uid].get("summary")
+        budget = TIER_CONTEXT_TOKENS.get(tier, TIER_CONTEXT_TOKENS["Basic"]) - count_tokens(sys_msg["content"]) - count_tokens(text)
+        if summary: budget -= count_tokens(summary)
+        excerpts = await asyncio.to_thread(DOC_INDEX.search, uid, text, RETRIEVAL_TOP_K) if USERS[uid].get("docs") else []
+        docs_msg = []
+        if excerpts:
+            docs_msg = [{"role": "system", "content": "Relevant excerpts from the user's uploaded files:\n\n" + "\n\n".join(f"[{f}]\n{c}" for f, c in excerpts)}]
+            budget -= count_tokens(docs_msg[0]["content"])
+        past, overflow = build_context(history, max(budget, 0))
+        limit = SUMMARY_BACKLOG_FACTOR * TIER_CONTEXT_TOKENS.get(tier, TIER_CONTEXT_TOKENS["Basic"])
+        if sum(entry_tokens(m) for m in overflow) > limit:
+            dropped = len(overflow)
+            overflow = drop_backlog(history, overflow, limit)
+            dropped -= len(overflow)
+            METRICS.inc("bot_history_dropped_total", dropped, tier=tier)
+            logger.warning(f"Dropped {dropped} unsummarized turns for {uid}: summary backlog over {limit} tokens")
+        summary_msg = [{"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}] if summary else []
+        messages = [sys_msg] + summary_msg + past + docs_msg + [{"role": "user", "content": content}]
         
-        resp = client.chat.completions.create(
-            model=TIER_MODELS[USERS[uid]["tier"]], messages=messages, max_tokens=1500
-        )
-        reply = resp.choices[0].message.content
+        model, route = choose_model(tier, text, should_send_images, excerpts, sum(entry_tokens(m) for m in history[len(overflow):]) + (count_tokens(summary) if summary else 0))
+        name = USERS[uid]["name"] or ""
+        cache_key = response_cache_key(model, sys_msg["content"], name, summary, past, text) if RESPONSE_CACHE and not excerpts and len(content) == 1 else None
+        reply = cached_response(cache_key, name) if cache_key else None
+        streamed = False
+        if reply is None:
+            started = time.monotonic()
+            est_tokens = estimate_tokens(messages) + 1500
+            if STREAM_REPLIES:
+                async with OPENAI_POOL.request(tier, model, est_tokens, client.chat.completions.create, messages=messages, max_tokens=1500, stream=True, stream_options={"include_usage": True}) as stream:
+                    reply, usage = await stream_reply(update.message, stream)
+                streamed = True
+            else:
+                resp = await OPENAI_POOL.run(tier, model, est_tokens, client.chat.completions.create, messages=messages, max_tokens=1500)
+                reply, usage = resp.choices[0].message.content, resp.usage
+            record_usage(tier, model, usage)
+            elapsed = time.monotonic() - started
+            METRICS.inc("bot_model_routes_total", tier=tier, model=model, reason=route)
+            METRICS.observe("bot_routed_reply_seconds", elapsed, tier=tier, model=model, reason=route)
+            logger.info(f"Routed {uid} [{tier}] to {model} ({route}): {elapsed:.2f}s, {getattr(usage, 'total_tokens', '?')} tokens")
+            if cache_key and reply: cache_response(cache_key, reply, name)
+        else:
+            METRICS.inc("bot_response_cache_hits_total", tier=tier)
+        if not reply:  # nothing was sent: not stored, and the finally below refunds the message
+            METRICS.inc("bot_errors_total", where="chat", type="EmptyReply")
+            logger.warning(f"Empty completion for {uid} from {model}")
+            return await update.message.reply_text(t("ai_error"))
         
         history.append({"role": "user", "content": text})
         history.append({"role": "assistant", "content": reply})
-        USERS[uid]["history"] = history[-HISTORY_LIMIT:]
         USERS[uid]["last_bot_text"] = reply
-        USERS[uid]["used"] += 1
-        save_json(DB_FILE, USERS)
-        await update.message.reply_text(reply)
+        USERS.save(uid)
+        answered = True
+        if not streamed:
+            with METRICS.timer("bot_stage_seconds", stage="tg_send"): await update.message.reply_text(reply)
+        if overflow and uid not in FOLDING:
+            FOLDING.add(uid)
+            context.application.create_task(fold_into_summary(uid, overflow), update=update)
+    except rate_limit_error():
+        await update.message.reply_text(t("ai_busy"))
     except Exception as e:
-        await update.message.reply_text(f"Error: {e}")
+        METRICS.inc("bot_errors_total", where="chat", type=type(e).__name__)
+        logger.error(f"Chat failed for {uid}: {e}")
+        await update.message.reply_text(t("ai_error"))
+    finally:
+        if not answered: await USERS.incr(uid, "used", -1)
 
 async def user_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -592,30 +2244,37 @@ async def user_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not (is_pdf or is_html or is_txt):
         await update.message.reply_text("❌ I accept .html, .pdf, and .txt only.")
         return
+    if doc.file_size and doc.file_size > DOC_MAX_MB * 1024 * 1024:
+        await update.message.reply_text(get_text(uid, "file_too_big", mb=DOC_MAX_MB))
+        return
+    kind = "pdf" if is_pdf else "html" if is_html else "txt"
     USERS[uid]["temp_photos"] = []
     USERS[uid]["img_turn_count"] = 0
-    new_file = await context.bot.get_file(file_id)
-    download_path = f"temp_doc_{uid}_{file_name}"
-    await new_file.download_to_drive(download_path)
-    extracted_text = ""
+    download_path = f"temp_doc_{uid}_{os.path.basename(file_name)}"
     try:
-        if is_pdf:
-            reader = PdfReader(download_path)
-            for page in reader.pages: extracted_text += page.extract_text() + "\n"
-        elif is_html:
-            with open(download_path, "r", encoding="utf-8", errors="ignore") as f:
-                soup = BeautifulSoup(f, 'html.parser')
-                for script in soup(["script", "style"]): script.extract()
-                extracted_text = soup.get_text()
-        else:
-            with open(download_path, "r", encoding="utf-8", errors="ignore") as f: extracted_text = f.read()
-        lines = (line.strip() for line in extracted_text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        clean_text = '\n'.join(chunk for chunk in chunks if chunk)
-        context_msg = f"User uploaded '{file_name}'. CONTENT:\n{clean_text[:8000]}" 
+        start = time.monotonic()
+        new_file = await context.bot.get_file(file_id)
+        await new_file.download_to_drive(download_path)
+        downloaded = time.monotonic()
+        METRICS.observe("bot_stage_seconds", downloaded - start, stage="tg_download")
+        # The worker stops itself at the deadline; the wait_for margin only covers a single page that never finishes
+        clean_text, pages, truncated = await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(get_worker_pool(), extract_document, download_path, kind, DOC_INDEX_CHARS, DOC_MAX_PAGES, time.time() + DOC_TIMEOUT),
+            DOC_TIMEOUT + 10
+        )
+        METRICS.observe("bot_stage_seconds", time.monotonic() - downloaded, stage="doc_parse", kind=kind)
+        logger.info(f"Document '{file_name}' from {uid}: {doc.file_size or 0} bytes, download {downloaded - start:.2f}s, extract {time.monotonic() - downloaded:.2f}s, {pages} pages, {len(clean_text)} chars{' (truncated)' if truncated else ''}")
+        n_chunks = await asyncio.to_thread(DOC_INDEX.add, uid, file_name, clean_text)
+        docs = USERS[uid].setdefault("docs", [])
+        if file_name not in docs: docs.append(file_name)
+        context_msg = f"User uploaded '{file_name}' ({pages} pages, {n_chunks} indexed sections; relevant sections are attached to later messages). BEGINNING:\n{clean_text[:DOC_PREVIEW_CHARS]}" 
         USERS[uid]["history"].append({"role": "system", "content": context_msg})
-        save_json(DB_FILE, USERS)
+        USERS.save(uid)
         await update.message.reply_text(get_text(uid, "file_read"))
+    except TimeoutError:
+        METRICS.inc("bot_errors_total", where="document", type="TimeoutError")
+        logger.warning(f"Document '{file_name}' from {uid}: extraction exceeded {DOC_TIMEOUT:.0f}s")
+        await update.message.reply_text(get_text(uid, "file_timeout", s=f"{DOC_TIMEOUT:.0f}"))
     except Exception as e: await update.message.reply_text(f"❌ Error: {e}")
     finally:
         if os.path.exists(download_path): os.remove(download_path)
@@ -637,115 +2296,307 @@ async def user_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not content: return await query.edit_message_text("❌ Expired.")
     ts = datetime.datetime.now().strftime("%H%M%S")
     filename = f"file_{ts}.{fmt}"
+    key = (hashlib.sha256(content.encode("utf-8")).hexdigest(), fmt)
     try:
-        code_match = re.search(r"```(\w+)?\n(.*?)```", content, re.DOTALL)
-        body = code_match.group(2) if code_match else content
-        if fmt == "pdf":
-            pdf = FPDF()
-            pdf.add_page()
-            pdf.set_font("Arial", size=12)
-            pdf.multi_cell(0, 10, body.encode('latin-1', 'replace').decode('latin-1'))
-            pdf.output(filename)
-        elif fmt == "docx":
-            doc = Document()
-            doc.add_paragraph(body)
-            doc.save(filename)
-        else:
-            with open(filename, "w", encoding="utf-8") as f: f.write(body)
-        await context.bot.send_document(chat_id=uid, document=open(filename, "rb"), caption=f"📄 .{fmt.upper()} File")
+        data = FILE_CACHE.get(key)
+        if data is None:
+            with METRICS.timer("bot_stage_seconds", stage="export_render", fmt=fmt):
+                data = await asyncio.get_running_loop().run_in_executor(get_worker_pool(), render_export, export_body(content), fmt, find_pdf_font())
+            FILE_CACHE.put(key, data)
+        await context.bot.send_document(chat_id=uid, document=data, filename=filename, caption=f"📄 .{fmt.upper()} File")
         await query.delete_message()
-    except Exception as e: await context.bot.send_message(chat_id=uid, text=f"Error: {e}")
-    finally:
-        if os.path.exists(filename): os.remove(filename)
+    except Exception as e:
+        METRICS.inc("bot_errors_total", where="export", type=type(e).__name__)
+        await context.bot.send_message(chat_id=uid, text=f"Error: {e}")
 
-async def user_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    uid = user.id
-    check_user(user)
-    if not USERS[uid]["approved"]: return
+PENDING_ALBUMS = {}  # (uid, media_group_id) -> {"updates": [...], "deadline": monotonic time}; per process, not shared by workers
+
+async def download_photo(bot, photo):
+    """Stores one uploaded photo in MEDIA, returning its temp_photos entry."""
+    path = MEDIA.path(photo.file_unique_id)
+    if os.path.exists(path): METRICS.inc("bot_media_dedup_total")  # same picture already uploaded by someone
+    await MEDIA.fetch(bot, photo.file_id, path)
+    return {"path": path, "file_id": photo.file_id}
+
+async def ingest_photos(updates, context):
+    """Stores the photos of one message or one whole album: parallel downloads, one save, one reply or vision request."""
+    update = updates[-1]
+    uid = update.effective_user.id
     tier = USERS[uid]["tier"]
     p_limit = TIER_PHOTO_LIMITS.get(tier, 50)
-    if USERS[uid]["photos_used"] >= p_limit:
+    room = await USERS.reserve(uid, "photos_used", p_limit, len(updates))
+    if not room:
         await update.message.reply_text(get_text(uid, "photo_limit", used=USERS[uid]["photos_used"], limit=p_limit))
         return
-    f = await update.message.photo[-1].get_file()
-    path = f"img_{uid}_{datetime.datetime.now().strftime('%H%M%S')}.jpg"
-    await f.download_to_drive(path)
+    try: entries = await asyncio.gather(*(download_photo(context.bot, u.message.photo[-1]) for u in updates[:room]))
+    except Exception:
+        await USERS.incr(uid, "photos_used", -room)
+        raise
     if "temp_photos" not in USERS[uid]: USERS[uid]["temp_photos"] = []
-    USERS[uid]["temp_photos"].append(path)
+    USERS[uid]["temp_photos"].extend(entries)
     USERS[uid]["img_turn_count"] = 0
-    USERS[uid]["photos_used"] += 1
-    save_json(DB_FILE, USERS)
-    if update.message.caption:
-        update.message.text = update.message.caption
-        await user_message(update, context)
+    USERS.save(uid)
+    if len(updates) > room: await update.message.reply_text(get_text(uid, "photo_limit", used=USERS[uid]["photos_used"], limit=p_limit))
+    captioned = next((u for u in updates[:room] if u.message.caption), None)
+    if captioned: await user_message(captioned, context)
     else:
         await update.message.reply_text(get_text(uid, "img_received", count=len(USERS[uid]["temp_photos"])), reply_markup=get_main_keyboard(uid))
 
+async def ingest_album(key, context):
+    """Ingests a pending album; the caller holds the user's lock."""
+    album = PENDING_ALBUMS.pop(key)
+    start = time.monotonic()
+    try: await ingest_photos(album["updates"], context)
+    except Exception as e:
+        METRICS.inc("bot_errors_total", where="flush_album", type=type(e).__name__)
+        logger.error(f"Album for {key[0]} failed: {e}")
+    finally: METRICS.observe("bot_handler_seconds", time.monotonic() - start, handler="flush_album")
+
+async def flush_album(key, context):
+    """Waits until no photo of the album arrived for ALBUM_DEBOUNCE seconds, then ingests it under the user's lock."""
+    album = PENDING_ALBUMS.get(key)
+    if album is None: return  # already ingested before this task started
+    while (delay := album["deadline"] - time.monotonic()) > 0: await asyncio.sleep(delay)
+    async with USERS.lock(key[0]):
+        if PENDING_ALBUMS.get(key) is album: await ingest_album(key, context)  # else a later update already ingested it
+
+async def flush_pending_albums(update, context):
+    """Ingests the sender's albums still in their debounce window, so an update sent after an album is handled after it.
+
+    Called by per_user with the lock held; photos of the album that is still arriving don't flush it.
+    """
+    uid = update.effective_user.id
+    group = update.message.media_group_id if update.message else None
+    for key in [k for k in PENDING_ALBUMS if k[0] == uid and k[1] != group]: await ingest_album(key, context)
+
+async def user_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    uid = user.id
+    check_user(user)
+    if not USERS[uid]["approved"]: return
+    group = update.message.media_group_id
+    if not group:
+        await ingest_photos([update], context)
+        return
+    # Telegram delivers an album as one update per photo; collect them and handle the album once
+    key = (uid, group)
+    album = PENDING_ALBUMS.get(key)
+    if album is None:
+        album = PENDING_ALBUMS[key] = {"updates": [], "deadline": 0}
+        context.application.create_task(flush_album(key, context), update=update)
+    album["updates"].append(update)
+    album["deadline"] = time.monotonic() + ALBUM_DEBOUNCE
+
 async def admin_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     if text.startswith("/login") and len(text.split()) > 1:
         if text.split()[1] == ADMIN_PASSWORD:
-            ADMINS[update.effective_user.id] = {"name": update.effective_user.first_name}
-            save_json(ADMINS_FILE, ADMINS)
+            await USERS.add_admin(update.effective_user.id, {"name": update.effective_user.first_name})
             await update.message.reply_text("✅ Logged in!")
         else: await update.message.reply_text("❌ Bad password.")
 
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast [tier=Pro] [lang=ru] text: messages approved users in the background and reports delivery"""
+    if update.effective_user.id not in await USERS.admins() or not user_bot_app: return
+    parts = (update.message.text or "").split(maxsplit=1)[1:]
+    words = parts[0].split(" ") if parts else []
+    wanted = {}
+    while words and re.fullmatch(r"(tier|lang)=\S+", words[0]):
+        key, value = words.pop(0).split("=", 1)
+        wanted[key] = value
+    text = " ".join(words).strip()
+    valid = wanted.get("tier", "Basic") in TIER_MODELS and wanted.get("lang", "en") in TEXTS  # a typo must not reach everyone or no one
+    if not text or not valid: return await update.message.reply_text(f"Usage: /broadcast [tier={'|'.join(TIER_MODELS)}] [lang={'|'.join(TEXTS)}] message")
+    targets = await USERS.audience(wanted)
+    await update.message.reply_text(f"📣 Sending to {len(targets)} users...")
+
+    async def deliver():
+        fan = FanOut(user_bot_app.bot)
+        start = time.monotonic()
+        await fan.send(targets, text=text)
+        failed = [uid for uid, status in fan.results.items() if status != "ok"]
+        if failed: logger.info(f"Broadcast not delivered to {len(failed)} users: {failed[:50]}")
+        counts = ", ".join(f"{status} {n}" for status, n in sorted(fan.summary().items())) or "nobody"
+        await update.message.reply_text(f"✅ Broadcast finished in {time.monotonic() - start:.0f}s: {counts}")
+    context.application.create_task(deliver(), update=update)
+
+async def admin_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows OpenAI slot usage per tier, requests waiting for rate budget per model and image jobs"""
+    if update.effective_user.id not in await USERS.admins(): return
+    lines = ["📊 **OpenAI queue**"]
+    for tier, st in OPENAI_POOL.stats().items():
+        lines.append(f"{tier}: {st['active']}/{st['limit']} active, {st['waiting']} waiting, avg wait {st['avg_wait']:.2f}s, max {st['max_wait']:.1f}s")
+    for model, depth in RATE_SCHEDULER.stats().items():
+        lines.append(f"{model} rate queue: " + ", ".join(f"{tier} {n}" for tier, n in depth.items()))
+    jobs = IMAGE_JOBS.stats()
+    lines.append(f"Image jobs: {jobs['waiting']} waiting, running " + (", ".join(f"{tier} {n}" for tier, n in jobs["running"].items()) or "none"))
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Summarizes latency percentiles, token spend per tier/model and error counts"""
+    if update.effective_user.id not in await USERS.admins(): return
+    lines = ["⏱ Latency (count / p50 / p99)"]
+    for key in sorted(METRICS.samples):
+        name, labels = key
+        label = ",".join(str(v) for _, v in labels)
+        lines.append(f"{name.replace('bot_', '').replace('_seconds', '')} [{label}]: {METRICS.hists[key][2]} / {METRICS.percentile(key, 0.5):.2f}s / {METRICS.percentile(key, 0.99):.2f}s")
+    spend = {}
+    for (name, labels), value in METRICS.counters.items():
+        labels = dict(labels)
+        if name == "bot_tokens_total": spend.setdefault((labels["tier"], labels["model"]), [0, 0.0])[0] += value
+        elif name == "bot_cost_usd_total": spend.setdefault((labels["tier"], labels["model"]), [0, 0.0])[1] += value
+    lines.append("💰 Spend (tokens / USD)")
+    for (tier, model), (tokens, cost) in sorted(spend.items()): lines.append(f"{tier} {model}: {tokens:,} / ${cost:.2f}")
+    errors = [(dict(labels), value) for (name, labels), value in METRICS.counters.items() if name == "bot_errors_total"]
+    lines.append("❗ Errors")
+    for labels, value in sorted(errors, key=lambda e: -e[1]): lines.append(f"{labels['where']} {labels['type']}: {value}")
+    await update.message.reply_text("\n".join(lines))
+
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if query.from_user.id not in await USERS.admins(): return
     await query.answer()
     act, tid = query.data.split("_")
     tid = int(tid)
-    if tid not in USERS: return
-    if act == "ok":
-        USERS[tid]["approved"] = True
-        if user_bot_app: await user_bot_app.bot.send_message(tid, TEXTS["en"]["approved"], reply_markup=get_main_keyboard(tid))
-        await query.edit_message_text(f"✅ Allowed {USERS[tid]['name']}")
-    elif act == "no":
-        USERS[tid]["approved"] = False
-        if user_bot_app: await user_bot_app.bot.send_message(tid, TEXTS["en"]["declined"])
-        await query.edit_message_text(f"❌ Denied {USERS[tid]['name']}")
-    elif act == "block":
-        USERS[tid]["approved"] = False
-        USERS[tid]["phone"] = None
-        if user_bot_app: await user_bot_app.bot.send_message(tid, TEXTS["en"]["blocked"])
-        await query.edit_message_text(f"🚫 Blocked {USERS[tid]['name']}")
-    save_json(DB_FILE, USERS)
-
-global user_bot_app, admin_bot_app
+    async with USERS.lock(tid):
+        if tid not in USERS: return
+        if act == "ok":
+            USERS[tid]["approved"] = True
+            await USERS.commit(tid)
+            if user_bot_app: await user_bot_app.bot.send_message(tid, TEXTS["en"]["approved"], reply_markup=get_main_keyboard(tid))
+            await query.edit_message_text(f"✅ Allowed {USERS[tid]['name']}")
+        elif act == "no":
+            USERS[tid]["approved"] = False
+            await USERS.commit(tid)
+            if user_bot_app: await user_bot_app.bot.send_message(tid, TEXTS["en"]["declined"])
+            await query.edit_message_text(f"❌ Denied {USERS[tid]['name']}")
+        elif act == "block":
+            USERS[tid]["approved"] = False
+            USERS[tid]["phone"] = None
+            await USERS.commit(tid)
+            if user_bot_app: await user_bot_app.bot.send_message(tid, TEXTS["en"]["blocked"])
+            await query.edit_message_text(f"🚫 Blocked {USERS[tid]['name']}")
+
+# --- WEBHOOKS ---
+WEBHOOK_PATHS = {"user": "/telegram/user", "admin": "/telegram/admin"}
+
+def build_web_app(apps, secret=None, metrics=False):
+    """aiohttp app that feeds webhook POSTs into each bot's update queue; `apps` maps WEBHOOK_PATHS keys to Applications.
+
+    POSTs must carry `secret` in Telegram's secret-token header, otherwise anyone could forge updates (payments, admin buttons).
+    `metrics` adds /metrics (spend, errors, traffic); only pass it for a private listener or with METRICS_TOKEN set.
+    """
+    from aiohttp import web
+
+    def make_handler(app):
+        async def handle(request):
+            if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+                return web.Response(status=403)
+            try: update = Update.de_json(await request.json(), app.bot)
+            except Exception: return web.Response(status=400)
+            await app.update_queue.put(update)
+            return web.Response()
+        return handle
+
+    async def health(request):
+        return web.Response(text="ok")
+
+    async def scrape(request):
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            return web.Response(status=403)
+        return web.Response(text=METRICS.render(), content_type="text/plain")
+
+    web_app = web.Application()
+    for name, app in apps.items(): web_app.router.add_post(WEBHOOK_PATHS[name], make_handler(app))
+    web_app.router.add_get("/healthz", health)
+    if metrics: web_app.router.add_get("/metrics", scrape)
+    return web_app
+
+async def start_http_server(apps, host, port, secret=None, metrics=False):
+    from aiohttp import web
+    runner = web.AppRunner(build_web_app(apps, secret, metrics))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+async def start_webhooks(apps):
+    """Starts the shared HTTP server and points each bot's webhook at it. Returns the runner to clean up on shutdown."""
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    runner = await start_http_server(apps, WEBHOOK_LISTEN, WEBHOOK_PORT, secret, metrics=bool(METRICS_TOKEN))
+    for name, app in apps.items():
+        await app.bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATHS[name], secret_token=secret, allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    logger.info(f"Webhooks listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT} for {WEBHOOK_URL}")
+    return runner
+
+def app_builder(token):
+    builder = Application.builder().token(token).read_timeout(30).write_timeout(30).connection_pool_size(TELEGRAM_POOL_SIZE).pool_timeout(30)
+    if TELEGRAM_API_URL: builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    return builder
+
+def build_user_app():
+    builder = app_builder(BOT_TOKEN)
+    # Updates of different users run in parallel; per_user keeps each user's updates in order, one at a time
+    if CONCURRENT_UPDATES: builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", instrumented(per_user(user_start))))
+    app.add_handler(MessageHandler(filters.CONTACT, instrumented(per_user(user_contact))))
+    app.add_handler(MessageHandler(filters.Document.ALL, instrumented(per_user(user_document))))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(per_user(user_message))))
+    app.add_handler(MessageHandler(filters.PHOTO, instrumented(per_user(user_photo))))
+    app.add_handler(CallbackQueryHandler(instrumented(per_user(user_file_callback)), pattern="^fmt_"))
+    
+    # PAYMENT HANDLERS
+    app.add_handler(CallbackQueryHandler(instrumented(per_user(payment_method_callback)), pattern="^buy_"))
+    app.add_handler(CallbackQueryHandler(instrumented(per_user(send_invoice_callback)), pattern="^pay_"))
+    app.add_handler(PreCheckoutQueryHandler(instrumented(precheckout_callback)))  # no user lock: Telegram wants the answer within 10 s
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, instrumented(per_user(successful_payment_callback))))
+    return app
+
+def build_admin_app():
+    app = app_builder(ADMIN_BOT_TOKEN).build()
+    app.add_handler(CommandHandler("login", instrumented(admin_login)))
+    app.add_handler(CommandHandler("queue", instrumented(admin_queue)))
+    app.add_handler(CommandHandler("stats", instrumented(admin_stats)))
+    app.add_handler(CommandHandler("broadcast", instrumented(admin_broadcast)))
+    app.add_handler(CallbackQueryHandler(instrumented(admin_callback)))
+    return app
+
+user_bot_app = admin_bot_app = None
 def main():
     global user_bot_app, admin_bot_app
     if os.name == 'nt': asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    user_bot_app = Application.builder().token(BOT_TOKEN).read_timeout(30).write_timeout(30).build()
-    user_bot_app.add_handler(CommandHandler("start", user_start))
-    user_bot_app.add_handler(MessageHandler(filters.CONTACT, user_contact))
-    user_bot_app.add_handler(MessageHandler(filters.Document.ALL, user_document))
-    user_bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, user_message))
-    user_bot_app.add_handler(MessageHandler(filters.PHOTO, user_photo))
-    user_bot_app.add_handler(CallbackQueryHandler(user_file_callback, pattern="^fmt_"))
-    
-    # PAYMENT HANDLERS
-    user_bot_app.add_handler(CallbackQueryHandler(payment_method_callback, pattern="^buy_"))
-    user_bot_app.add_handler(CallbackQueryHandler(send_invoice_callback, pattern="^pay_"))
-    user_bot_app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    user_bot_app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-
-    admin_bot_app = Application.builder().token(ADMIN_BOT_TOKEN).read_timeout(30).write_timeout(30).build()
-    admin_bot_app.add_handler(CommandHandler("login", admin_login))
-    admin_bot_app.add_handler(CallbackQueryHandler(admin_callback))
-    print("🚀 Bots Running...")
+    user_bot_app = build_user_app()
+    admin_bot_app = build_admin_app()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     async def runner():
-        await user_bot_app.initialize()
-        await user_bot_app.start()
-        await user_bot_app.updater.start_polling(drop_pending_updates=True)
-        await admin_bot_app.initialize()
-        await admin_bot_app.start()
-        await admin_bot_app.updater.start_polling(drop_pending_updates=True)
-        while True: await asyncio.sleep(10)
+        apps = {"user": user_bot_app, "admin": admin_bot_app}
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try: loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError: pass
+        for app in apps.values():
+            await app.initialize()
+            await app.start()
+        web_runners = []
+        if WEBHOOK_URL: web_runners.append(await start_webhooks(apps))
+        else:
+            for app in apps.values(): await app.updater.start_polling(drop_pending_updates=True)
+        if METRICS_PORT: web_runners.append(await start_http_server({}, METRICS_LISTEN, METRICS_PORT, metrics=True))
+        loop.run_in_executor(None, lambda: client.chat)  # import openai in the background while the bots already take updates
+        loop.run_in_executor(None, load_encoding)  # byte estimates until the tokenizer is ready
+        print("🚀 Bots Running...")
+        try: await stop.wait()
+        finally:
+            logger.info("Shutting down...")
+            for web_runner in web_runners: await web_runner.cleanup()
+            for app in apps.values():
+                if app.updater and app.updater.running: await app.updater.stop()
+                await app.stop()
+                await app.shutdown()
     try: loop.run_until_complete(runner())
     except KeyboardInterrupt: pass
+    finally: USERS.flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,78 @@
+"""Minimal OpenAI API stand-in for benchmarks (point OPENAI_BASE_URL at it).
+
+Serves /v1/chat/completions (plain and streamed) and /v1/images/generations with configurable
+latency and 429 injection.
+"""
+import json
+import time
+import random
+import asyncio
+import itertools
+
+class FakeOpenAI:
+    def __init__(self, latency=0.5, token_delay=0.0, error_rate=0.0, reply_tokens=60, seed=0):
+        self.latency = latency  # time to first token / full response overhead
+        self.token_delay = token_delay  # extra delay per streamed token
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.ids = itertools.count(1)
+        self.runner = None
+
+    def _rate_limited(self):
+        from aiohttp import web
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, status=429, headers={"retry-after": "0.5"})
+        return None
+
+    async def _chat(self, request):
+        from aiohttp import web
+        body = await request.json()
+        self.calls["chat"] = self.calls.get("chat", 0) + 1
+        await asyncio.sleep(self.latency)
+        error = self._rate_limited()
+        if error: return error
+        prompt_tokens = len(json.dumps(body["messages"])) // 4
+        words = [f"word{i}" for i in range(self.reply_tokens)]
+        base = {"id": f"chatcmpl-{next(self.ids)}", "created": int(time.time()), "model": body["model"]}
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+        if not body.get("stream"):
+            return web.json_response({**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": " ".join(words)}}
+            ]})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i, word in enumerate(words):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.token_delay: await asyncio.sleep(self.token_delay)
+        if body.get("stream_options", {}).get("include_usage"):
+            await resp.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def _images(self, request):
+        from aiohttp import web
+        body = await request.json()
+        self.calls["images"] = self.calls.get("images", 0) + 1
+        await asyncio.sleep(self.latency * 4)
+        error = self._rate_limited()
+        if error: return error
+        item = {"b64_json": "/9j/2w=="} if body.get("response_format") == "b64_json" else {"url": "https://example.com/fake.png"}
+        return web.json_response({"created": int(time.time()), "data": [item] * body.get("n", 1)})
+
+    async def start(self, host="127.0.0.1", port=8082):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/images/generations", self._images)
+        app.router.add_get("/_calls", lambda request: web.json_response(self.calls))
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self):
+        if self.runner: await self.runner.cleanup()
@@ -0,0 +1,168 @@
+"""Local Telegram stand-ins.
+
+Posts synthetic updates to a bot running in webhook mode:
+
+    python fake_telegram.py --text "hello"
+    python fake_telegram.py --bot admin --text "/login secret" --uid 42
+
+FakeBotAPI is a minimal Bot API server (point TELEGRAM_API_URL at it) used by benchmark.py.
+"""
+import os
+import io
+import random
+import asyncio
+import argparse
+import itertools
+import time
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_PATHS = {"user": "/telegram/user", "admin": "/telegram/admin"}
+
+_update_ids = itertools.count(int(time.time()))
+
+def message_update(uid, text, first_name="Test"):
+    """A private-chat text message update as Telegram would deliver it."""
+    update_id = next(_update_ids)
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private", "first_name": first_name},
+        "from": {"id": uid, "is_bot": False, "first_name": first_name},
+        "text": text
+    }
+    if text.startswith("/"): msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": msg}
+
+def photo_update(uid, file_id, caption=None, media_group_id=None):
+    update_id = next(_update_ids)
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "Test"},
+        "photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600, "file_size": 20000}]
+    }
+    if caption: msg["caption"] = caption
+    if media_group_id: msg["media_group_id"] = media_group_id
+    return {"update_id": update_id, "message": msg}
+
+def document_update(uid, file_id, file_name, file_size=2000):
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "message": {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "Test"},
+        "document": {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "file_size": file_size}
+    }}
+
+def callback_update(uid, data):
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id),
+        "from": {"id": uid, "is_bot": False, "first_name": "Test"},
+        "chat_instance": str(uid),
+        "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "text": "menu"}
+    }}
+
+def post_update(update, bot="user", base_url=None):
+    url = (base_url or f"http://127.0.0.1:{WEBHOOK_PORT}") + WEBHOOK_PATHS[bot]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    return httpx.post(url, json=update, headers=headers, timeout=10)
+
+class FakeBotAPI:
+    """Answers the Bot API methods the bots use, with configurable latency and 429 injection.
+
+    Photos are served as a small JPEG and documents as plain text; every call is counted in `calls`.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.message_ids = itertools.count(1)
+        self.jpeg = self._make_jpeg()
+        self.runner = None
+
+    @staticmethod
+    def _make_jpeg():
+        try:
+            from PIL import Image
+            buf = io.BytesIO()
+            Image.new("RGB", (64, 48), (120, 160, 200)).save(buf, "JPEG")
+            return buf.getvalue()
+        except ImportError:
+            return b"\xff\xd8\xff\xd9"
+
+    def _message(self, chat_id, **extra):
+        return {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    async def _method(self, request):
+        from aiohttp import web
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency: await asyncio.sleep(self.latency)
+        if self.error_rate and method != "getMe" and self.random.random() < self.error_rate:
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}}, status=429)
+        if request.content_type == "application/json": params = await request.json()
+        else: params = dict(await request.post())
+        chat_id = params.get("chat_id", 1)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot", "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        elif method == "getFile":
+            file_id = params["file_id"]
+            kind = "documents" if file_id.startswith("doc") else "photos"
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": 1000, "file_path": f"{kind}/{file_id}"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "sendDocument":
+            result = self._message(chat_id, document={"file_id": "out", "file_unique_id": "out"})
+        elif method == "sendPhoto":
+            result = self._message(chat_id, photo=[{"file_id": "out", "file_unique_id": "out", "width": 1, "height": 1}])
+        elif method == "sendMediaGroup":
+            result = [self._message(chat_id, photo=[{"file_id": "out", "file_unique_id": "out", "width": 1, "height": 1}])]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _file(self, request):
+        from aiohttp import web
+        path = request.match_info["path"]
+        if path.startswith("documents/"):
+            body = "\n".join(f"Section {i}: synthetic benchmark text about topic {i % 17}." for i in range(200))
+            return web.Response(body=body.encode("utf-8"))
+        return web.Response(body=self.jpeg, content_type="image/jpeg")
+
+    async def start(self, host="127.0.0.1", port=8081):
+        from aiohttp import web
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+        app.router.add_get("/_calls", lambda request: web.json_response(self.calls))
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner: await self.runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="Post a fake Telegram update to the local webhook server")
+    parser.add_argument("--bot", choices=list(WEBHOOK_PATHS), default="user")
+    parser.add_argument("--uid", type=int, default=1)
+    parser.add_argument("--text", required=True)
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--url", help="Server base URL (default http://127.0.0.1:WEBHOOK_PORT)")
+    args = parser.parse_args()
+    for _ in range(args.count):
+        resp = post_update(message_update(args.uid, args.text), args.bot, args.url)
+        print(resp.status_code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""CPU-bound jobs for the bot's process pool: document text extraction and file export rendering.
+
+Kept out of bot_chatgpt.py and free of import-time side effects, so pool workers (which may be started
+with spawn or forkserver) only import this module and the parsers a job needs.
+"""
+import io
+import time
+
+def extract_document(path, kind, max_chars, max_pages, deadline):
+    """Extracts cleaned text page by page, stopping once max_chars or max_pages is reached.
+
+    Returns (text, pages_read, truncated). Raises TimeoutError once time.time() passes `deadline`, so a slow
+    file frees its worker instead of parsing on after the caller gave up.
+    """
+    parts, size, pages = [], 0, 0
+
+    def check_deadline():
+        if time.time() > deadline: raise TimeoutError(f"extraction stopped after {pages} pages")
+
+    def add(raw):
+        nonlocal size
+        for line in raw.splitlines():
+            check_deadline()
+            for phrase in line.strip().split("  "):
+                phrase = phrase.strip()
+                if not phrase: continue
+                parts.append(phrase)
+                size += len(phrase) + 1
+                if size >= max_chars: return True
+        return False
+
+    truncated = False
+    if kind == "pdf":
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        for page in reader.pages:
+            if pages >= max_pages:
+                truncated = True
+                break
+            check_deadline()
+            pages += 1
+            if add(page.extract_text() or ""):
+                truncated = True
+                break
+    elif kind == "html":
+        from bs4 import BeautifulSoup
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            soup = BeautifulSoup(f, 'html.parser')
+        for script in soup(["script", "style"]): script.extract()
+        pages = 1
+        truncated = add(soup.get_text())
+    else:
+        pages = 1
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                if add(line):
+                    truncated = True
+                    break
+    return "\n".join(parts)[:max_chars], pages, truncated
+
+def render_export(body, fmt, font=None):
+    """Renders the export in memory and returns its bytes; `font` is a TTF for PDFs (Helvetica, Latin-1 only, without it)."""
+    if fmt == "pdf":
+        from fpdf import FPDF
+        pdf = FPDF()
+        pdf.add_page()
+        if font:
+            pdf.add_font("Body", fname=font)
+            pdf.set_font("Body", size=12)
+        else:
+            pdf.set_font("Helvetica", size=12)
+            body = body.encode('latin-1', 'replace').decode('latin-1')
+        pdf.multi_cell(0, 10, body)
+        return bytes(pdf.output())
+    if fmt == "docx":
+        from docx import Document
+        doc = Document()
+        for para in body.split("\n\n"): doc.add_paragraph(para)
+        buf = io.BytesIO()
+        doc.save(buf)
+        return buf.getvalue()
+    return body.encode("utf-8")